@@ -30,11 +30,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'dashboard.instrumentation.RequestInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'dashboard.members.MemberMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -43,7 +45,8 @@ ROOT_URLCONF = 'BonusDesk.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates с замером времени рендеринга для RequestInstrumentationMiddleware
+        'BACKEND': 'dashboard.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')]
         ,
         'APP_DIRS': True,
@@ -115,6 +118,28 @@ EMAIL_HOST_PASSWORD = '...'
 EMAIL_USE_TLS = '...'
 SERVER_EMAIL = '...'
 
+# START: Cache settings
+# Кэш в том же Redis, что и брокер Celery (отдельная база)
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}
+
+# Сессии читаются из Redis, в базу попадают только при записи (и переживают очистку кэша)
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Пользователь сессии вместе с профилем из кэша; ModelBackend - для уже открытых сессий
+AUTHENTICATION_BACKENDS = [
+    'dashboard.members.MemberBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+# END: Cache settings
+
 # START: CELERY settings
 CELERY_BROKER_URL = 'redis://localhost:6379'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379'
@@ -127,6 +152,10 @@ CELERY_BEAT_SCHEDULE = {
         "task": "dashboard.tasks.amount_counting",
         "schedule": crontab(0, 0, day_of_month=1),
     },
+    "save-referral-clicks": {
+        "task": "dashboard.tasks.save_referral_clicks",
+        "schedule": crontab(),
+    },
 }
 # END: CELERY settings
 
@@ -143,6 +172,28 @@ BRILLIANT = os.environ.get('BRILLIANT') or '2400000'
 BRILLIANT_BONUS = os.environ.get('BRILLIANT_BONUS') or '3600000'
 # END: Bonus System
 
+# START: Signup settings
+# Отложенное обновление дерева MPTT при регистрации: lft/rght пересчитываются в фоне задачей Celery
+SIGNUP_DELAY_MPTT_UPDATES = os.environ.get('SIGNUP_DELAY_MPTT_UPDATES') == 'True'
+# END: Signup settings
+
+# START: Instrumentation settings
+# Количество SQL-запросов, время SQL и шаблона, размер ответа: заголовок Server-Timing и сводка в журнале
+REQUEST_INSTRUMENTATION = os.environ.get('REQUEST_INSTRUMENTATION', 'True') == 'True'
+REQUEST_INSTRUMENTATION_LOG_INTERVAL = int(os.environ.get('REQUEST_INSTRUMENTATION_LOG_INTERVAL') or 60)
+# Бюджет SQL-запросов по имени url; при превышении - предупреждение в журнале, в тестах - ошибка
+QUERY_BUDGETS = {
+    'dashboard': 15,
+    'username_autocomplete': 5,
+    'search_user_information': 25,
+    'user_information': 15,
+    'referral_children': 10,
+    'specify_parent': 80,
+    'leaderboard': 5,
+}
+QUERY_BUDGETS_STRICT = os.environ.get('QUERY_BUDGETS_STRICT') == 'True'
+# END: Instrumentation settings
+
 # START: Logging settings
 LOGGING = {
     'version': 1,
@@ -168,12 +219,34 @@ LOGGING = {
             'maxBytes': 1024*1024*5,
             'formatter': 'simple',
         },
+        'performance': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': 'logging/performance.log',
+            'maxBytes': 1024*1024*5,
+            'formatter': 'simple',
+        },
     },
     'loggers': {
         'django': {
             'level': os.getenv('DJANGO_LOG_LEVEL', 'DEBUG'),
             'handlers': ['debug', 'error'],
         },
+        # SQL-запросы собирает RequestInstrumentationMiddleware; в журнал каждый запрос не пишем
+        'django.db.backends': {
+            'level': os.getenv('DJANGO_DB_LOG_LEVEL', 'INFO'),
+            'handlers': ['debug', 'error'],
+            'propagate': False,
+        },
+        'dashboard.instrumentation': {
+            'level': 'INFO',
+            'handlers': ['performance', 'error'],
+        },
+        # Переходы по реферальным ссылкам, не записанные из очереди в базу
+        'dashboard.referral_clicks': {
+            'level': 'INFO',
+            'handlers': ['debug', 'error'],
+        },
     },
 }
 # END: Logging settings
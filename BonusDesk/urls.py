@@ -8,7 +8,10 @@ from django.contrib.auth.views import (
     login,
     logout,
 )
-from dashboard.views import SignupView
+from dashboard.views import (
+    SignupView,
+    process_referral,
+)
 from django.core.urlresolvers import reverse_lazy
 
 
@@ -66,6 +69,13 @@ urlpatterns = [
         include("account.urls")
     ),
 
+    # Referral link: code from cache, click goes to the queue (before 'pinax-referrals' urls)
+    url(
+        r'^referrals/(?P<code>\w+)/$',
+        process_referral,
+        name='process_referral'
+    ),
+
     # url settings of 'pinax-referrals' application
     url(
         r"^referrals/",
@@ -1,11 +1,66 @@
-from django.contrib import admin
+import io
+from datetime import date
+from django.conf.urls import url
+from django.contrib import (
+    admin,
+    messages,
+)
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connection
+from django.shortcuts import (
+    get_object_or_404,
+    redirect,
+    render,
+)
+from django.utils.functional import cached_property
+from dashboard.forms import PaymentImportForm
+from dashboard.paid_members import get_paid_user_ids
+from dashboard.payment_import import (
+    import_payments,
+    mark_paid_for_month,
+    mark_payments_paid,
+)
 from dashboard.models import (
     Payment,
     Profile,
+    MonthlyBonus,
+    LeaderboardEntry,
+    AmountRollover,
 )
 
 
+# Начиная с какого размера таблицы в списке без фильтров показывается оценка количества строк
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+# Количество узлов на странице дерева пользователей
+TREE_PAGE_SIZE = 100
+
+
+class EstimatedCountPaginator(Paginator):
+    # COUNT(*) по всей таблице на каждой странице списка заменяем оценкой из статистики PostgreSQL.
+    # С фильтрами и поиском, а также для небольших таблиц считаем точно
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if connection.vendor == 'postgresql' and query is not None and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples FROM pg_class WHERE relname = %s',
+                    [self.object_list.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            if row and row[0] >= ESTIMATED_COUNT_THRESHOLD:
+                return int(row[0])
+        return super(EstimatedCountPaginator, self).count
+
+
 class PaymentAdmin(admin.ModelAdmin):
+    list_display = (
+        'user',
+        'date',
+        'paid',
+    )
     search_fields = (
         'user__username',
         'user__email',
@@ -14,16 +69,237 @@ class PaymentAdmin(admin.ModelAdmin):
         'paid',
         'date',
     )
+    raw_id_fields = (
+        'user',
+    )
+    list_select_related = (
+        'user',
+    )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = (
+        'mark_paid',
+    )
+    change_list_template = 'admin/dashboard/payment/change_list.html'
+
+    def get_urls(self):
+        urls = [
+            url(
+                r'^import/$',
+                self.admin_site.admin_view(self.import_payments_view),
+                name='dashboard_payment_import',
+            ),
+        ]
+        return urls + super(PaymentAdmin, self).get_urls()
+
+    def import_payments_view(self, request):
+        # Загрузка платежей из CSV одной операцией вместо изменения каждого платежа
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        if request.method == 'POST':
+            form = PaymentImportForm(request.POST, request.FILES)
+            if connection.vendor != 'postgresql':
+                form.add_error(None, 'Импорт платежей использует COPY и работает только с PostgreSQL')
+            elif form.is_valid():
+                result = import_payments(io.TextIOWrapper(form.cleaned_data['csv_file'].file, encoding='utf-8-sig'))
+                messages.success(request, (
+                    'Строк: %(rows)s, загружено: %(imported)s, создано платежей: %(created)s, '
+                    'изменено: %(updated)s, ошибок: %(errors_count)s' % result
+                ))
+                for line_number, message in result['errors']:
+                    messages.warning(request, 'Строка %s: %s' % (line_number, message))
+                return redirect('admin:dashboard_payment_changelist')
+        else:
+            form = PaymentImportForm()
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Загрузка платежей',
+            opts=self.model._meta,
+            form=form,
+        )
+        return render(request, 'admin/dashboard/payment/import_payments.html', context)
+
+    def mark_paid(self, request, queryset):
+        updated = mark_payments_paid(queryset)
+        self.message_user(request, 'Отмечено оплаченными платежей: %s' % updated)
+    mark_paid.short_description = 'Отметить выбранные платежи оплаченными'
 
 
 admin.site.register(Payment, PaymentAdmin)
 
 
 class ProfileAdmin(admin.ModelAdmin):
+    list_display = (
+        'user',
+        'last_name',
+        'first_name',
+        'parent',
+    )
     search_fields = (
         'user__username',
         'user__email',
     )
+    # Поля выбора пользователя и родителя - по id, без списка всех профилей в <select>
+    raw_id_fields = (
+        'user',
+        'referral',
+        'parent',
+    )
+    list_select_related = (
+        'user',
+        'parent__user',
+    )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = (
+        'mark_paid_for_current_month',
+    )
+    change_list_template = 'admin/dashboard/profile/change_list.html'
+
+    def get_urls(self):
+        urls = [
+            url(
+                r'^tree/$',
+                self.admin_site.admin_view(self.tree_view),
+                name='dashboard_profile_tree',
+            ),
+        ]
+        return urls + super(ProfileAdmin, self).get_urls()
+
+    def tree_view(self, request):
+        # Дерево пользователей по одному уровню: корни деревьев или прямые последователи выбранного узла,
+        # постранично (по tree_id для корней, по lft для последователей)
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            after = int(request.GET.get('after') or 0)
+        except ValueError:
+            after = 0
+
+        profiles = Profile.objects.select_related('user')
+        if request.GET.get('node'):
+            node = get_object_or_404(profiles, id=request.GET['node'])
+            ancestors = list(node.get_ancestors().select_related('user'))
+            nodes = list(profiles.filter(parent=node, lft__gt=after).order_by('lft')[:TREE_PAGE_SIZE + 1])
+            next_after = nodes[TREE_PAGE_SIZE - 1].lft if len(nodes) > TREE_PAGE_SIZE else None
+        else:
+            node = None
+            ancestors = []
+            nodes = list(profiles.filter(level=0, tree_id__gt=after).order_by('tree_id')[:TREE_PAGE_SIZE + 1])
+            next_after = nodes[TREE_PAGE_SIZE - 1].tree_id if len(nodes) > TREE_PAGE_SIZE else None
+        nodes = nodes[:TREE_PAGE_SIZE]
+
+        # Статус оплаты за текущий месяц по карте оплативших (без нее - одним запросом на страницу)
+        paid_user_ids = get_paid_user_ids(
+            [profile.user_id for profile in nodes], date.today().year, date.today().month,
+        )
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Дерево пользователей',
+            opts=self.model._meta,
+            node=node,
+            ancestors=ancestors,
+            # Количество последователей узла по полям lft и rght, без запросов
+            nodes=[(profile, (profile.rght - profile.lft - 1) // 2, profile.user_id in paid_user_ids) for profile in nodes],
+            next_after=next_after,
+        )
+        return render(request, 'admin/dashboard/profile/tree.html', context)
+
+    def mark_paid_for_current_month(self, request, queryset):
+        marked = mark_paid_for_month(
+            queryset.values_list('user_id', flat=True),
+            date.today().year,
+            date.today().month,
+        )
+        self.message_user(request, 'Отмечена оплата за текущий месяц у пользователей: %s' % marked)
+    mark_paid_for_current_month.short_description = 'Отметить оплату за текущий месяц'
 
 
 admin.site.register(Profile, ProfileAdmin)
+
+
+class MonthlyBonusAdmin(admin.ModelAdmin):
+    list_display = (
+        'profile',
+        'period',
+        'first_level_bonus_referral_count',
+        'second_level_bonus_referral_count',
+        'third_level_bonus_referral_count',
+        'fourth_level_bonus_referral_count',
+        'amount_from_parent',
+        'month_amount',
+    )
+    list_filter = (
+        'period',
+    )
+    search_fields = (
+        'profile__user__username',
+        'profile__user__email',
+    )
+    raw_id_fields = (
+        'profile',
+    )
+    list_select_related = (
+        'profile__user',
+    )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+admin.site.register(MonthlyBonus, MonthlyBonusAdmin)
+
+
+class LeaderboardEntryAdmin(admin.ModelAdmin):
+    list_display = (
+        'rank',
+        'profile',
+        'value',
+        'board',
+        'period',
+    )
+    list_filter = (
+        'period',
+        'board',
+    )
+    search_fields = (
+        'profile__user__username',
+    )
+    raw_id_fields = (
+        'profile',
+    )
+    list_select_related = (
+        'profile__user',
+    )
+    ordering = ('period', 'board', 'rank')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+admin.site.register(LeaderboardEntry, LeaderboardEntryAdmin)
+
+
+class AmountRolloverAdmin(admin.ModelAdmin):
+    list_display = (
+        'profile',
+        'period',
+        'amount',
+        'created_at',
+    )
+    list_filter = (
+        'period',
+    )
+    search_fields = (
+        'profile__user__username',
+    )
+    raw_id_fields = (
+        'profile',
+    )
+    list_select_related = (
+        'profile__user',
+    )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+admin.site.register(AmountRollover, AmountRolloverAdmin)
@@ -0,0 +1,39 @@
+import hashlib
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+
+# Максимальное количество подсказок
+AUTOCOMPLETE_LIMIT = 10
+
+# Минимальная длина введенного логина (как minLength в jQuery UI autocomplete)
+AUTOCOMPLETE_MIN_LENGTH = 2
+
+# Популярные префиксы кэшируются ненадолго, чтобы новые пользователи быстро появлялись в подсказках
+AUTOCOMPLETE_CACHE_KEY = 'username_autocomplete:%s'
+AUTOCOMPLETE_CACHE_TIMEOUT = 30
+
+
+def search_usernames(term, limit=AUTOCOMPLETE_LIMIT):
+    term = term.strip()
+    if len(term) < AUTOCOMPLETE_MIN_LENGTH:
+        return []
+
+    key = AUTOCOMPLETE_CACHE_KEY % hashlib.md5(term.upper().encode('utf-8')).hexdigest()
+    results = cache.get(key)
+    if results is None:
+        # Сначала логины, начинающиеся с введенной строки (индекс по префиксу)
+        results = list(
+            User.objects.filter(username__istartswith=term).order_by('username').values_list('id', 'username')[:limit]
+        )
+        # Затем логины, содержащие строку (триграммный индекс), до общего лимита
+        if len(results) < limit:
+            results += list(
+                User.objects.filter(
+                    username__icontains=term,
+                ).exclude(
+                    username__istartswith=term,
+                ).order_by('username').values_list('id', 'username')[:limit - len(results)]
+            )
+        cache.set(key, results, AUTOCOMPLETE_CACHE_TIMEOUT)
+    return results
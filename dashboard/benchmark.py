@@ -0,0 +1,231 @@
+import gc
+import hashlib
+import random
+import time
+import tracemalloc
+from datetime import (
+    date,
+    timedelta,
+)
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse_lazy
+from pinax.referrals.models import Referral
+from dashboard.models import (
+    Payment,
+    Profile,
+    ReferralPath,
+)
+from dashboard.paid_members import update_paid_statuses
+from dashboard.tree import REFERRAL_PATH_DEPTH
+
+
+# Количество строк в одном INSERT при генерации
+FOREST_BATCH_SIZE = 5000
+
+# Из скольких последних добавленных узлов выбирается родитель при перекосе в глубину
+FOREST_SKEW_WINDOW = 10
+
+
+def generate_forest_structure(members, roots, branching, skew, rng):
+    # Родитель каждого участника (индексы): с вероятностью skew - один из последних добавленных узлов
+    # (длинные глубокие ветки), иначе - случайный узел, у которого меньше branching последователей
+    parents = []
+    levels = []
+    children_counts = [0] * members
+    open_nodes = []
+    for index in range(members):
+        if index < roots:
+            parent = None
+        else:
+            if rng.random() < skew:
+                position = len(open_nodes) - 1 - rng.randrange(min(len(open_nodes), FOREST_SKEW_WINDOW))
+            else:
+                position = rng.randrange(len(open_nodes))
+            parent = open_nodes[position]
+            children_counts[parent] += 1
+            if children_counts[parent] >= branching:
+                open_nodes[position] = open_nodes[-1]
+                open_nodes.pop()
+        parents.append(parent)
+        levels.append(0 if parent is None else levels[parent] + 1)
+        open_nodes.append(index)
+    return parents, levels
+
+
+def get_forest_mptt_fields(parents, first_tree_id):
+    # Поля lft, rght и tree_id обходом в глубину; последователи по порядку добавления (order_insertion_by = user)
+    members = len(parents)
+    children = [[] for index in range(members)]
+    roots = []
+    for index, parent in enumerate(parents):
+        if parent is None:
+            roots.append(index)
+        else:
+            children[parent].append(index)
+
+    lfts = [0] * members
+    rghts = [0] * members
+    tree_ids = [0] * members
+    for tree_offset, root in enumerate(roots):
+        counter = 1
+        stack = [(root, False)]
+        while stack:
+            index, visited = stack.pop()
+            if visited:
+                rghts[index] = counter
+                counter += 1
+                continue
+            lfts[index] = counter
+            tree_ids[index] = first_tree_id + tree_offset
+            counter += 1
+            stack.append((index, True))
+            stack.extend((child, False) for child in reversed(children[index]))
+    return lfts, rghts, tree_ids
+
+
+def get_month_starts(months):
+    # Первые числа последних months месяцев, начиная с текущего
+    month_starts = [date.today().replace(day=1)]
+    while len(month_starts) < months:
+        month_starts.append((month_starts[-1] - timedelta(days=1)).replace(day=1))
+    return month_starts
+
+
+def generate_referral_forest(members, roots=None, branching=5, skew=0.5, payment_ratio=0.7, months=1, seed=0,
+                             prefix='member', batch_size=FOREST_BATCH_SIZE):
+    # Воспроизводимый лес последователей: пользователи, профили с готовыми полями дерева, связи до четвертого
+    # уровня и платежи. Пишется пачками через bulk_create, сигналы и пересчеты дерева не выполняются
+    rng = random.Random(seed)
+    if roots is None:
+        roots = max(1, members // 1000)
+    parents, levels = generate_forest_structure(members, roots, branching, skew, rng)
+    first_tree_id = (Profile.objects.order_by('-tree_id').values_list('tree_id', flat=True).first() or 0) + 1
+    lfts, rghts, tree_ids = get_forest_mptt_fields(parents, first_tree_id)
+    usernames = ['%s%s' % (prefix, index) for index in range(members)]
+
+    # Пользователи и реферальные коды
+    password = make_password(None)
+    user_ids = []
+    for start in range(0, members, batch_size):
+        batch_usernames = usernames[start:start + batch_size]
+        users = []
+        for username in batch_usernames:
+            user = User(username=username, email='%s@example.com' % username, password=password)
+            user._disable_profile_creation = True
+            users.append(user)
+        User.objects.bulk_create(users)
+        ids = dict(User.objects.filter(username__in=batch_usernames).values_list('username', 'id'))
+        user_ids.extend(ids[username] for username in batch_usernames)
+        Referral.objects.bulk_create([
+            Referral(
+                user_id=ids[username],
+                code=hashlib.sha1(username.encode('utf-8')).hexdigest(),
+                redirect_to=str(reverse_lazy('account_signup')),
+            )
+            for username in batch_usernames
+        ])
+
+    # Профили по уровням: у родителя id уже есть
+    profile_ids = [None] * members
+    indexes_by_level = {}
+    for index, level in enumerate(levels):
+        indexes_by_level.setdefault(level, []).append(index)
+    for level in sorted(indexes_by_level):
+        indexes = indexes_by_level[level]
+        for start in range(0, len(indexes), batch_size):
+            batch = indexes[start:start + batch_size]
+            Profile.objects.bulk_create([
+                Profile(
+                    user_id=user_ids[index],
+                    parent_id=profile_ids[parents[index]] if parents[index] is not None else None,
+                    tree_id=tree_ids[index],
+                    lft=lfts[index],
+                    rght=rghts[index],
+                    level=level,
+                    first_name='Имя %s' % index,
+                    last_name='Фамилия %s' % index,
+                    middle_name='Отчество %s' % index,
+                    address='Адрес %s' % index,
+                )
+                for index in batch
+            ])
+            ids = dict(Profile.objects.filter(
+                user_id__in=[user_ids[index] for index in batch],
+            ).values_list('user_id', 'id'))
+            for index in batch:
+                profile_ids[index] = ids[user_ids[index]]
+
+    # Связи с предками до четвертого уровня
+    paths = []
+    paths_count = 0
+    for index in range(members):
+        ancestor = parents[index]
+        depth = 1
+        while ancestor is not None and depth <= REFERRAL_PATH_DEPTH:
+            paths.append(ReferralPath(ancestor_id=profile_ids[ancestor], descendant_id=profile_ids[index], depth=depth))
+            ancestor = parents[ancestor]
+            depth += 1
+        if len(paths) >= batch_size:
+            ReferralPath.objects.bulk_create(paths)
+            paths_count += len(paths)
+            paths = []
+    ReferralPath.objects.bulk_create(paths)
+    paths_count += len(paths)
+
+    # Платежи: доля payment_ratio участников оплачивает каждый месяц
+    payments = []
+    payments_count = 0
+    for month_start in get_month_starts(months):
+        # Платежи текущего месяца - не позже сегодняшнего дня
+        if month_start == date.today().replace(day=1):
+            last_day = min(28, date.today().day)
+        else:
+            last_day = 28
+        for index in range(members):
+            if rng.random() < payment_ratio:
+                payments.append(Payment(
+                    user_id=user_ids[index],
+                    date=month_start.replace(day=rng.randint(1, last_day)),
+                    paid=True,
+                ))
+            if len(payments) >= batch_size:
+                Payment.objects.bulk_create(payments)
+                payments_count += len(payments)
+                payments = []
+    Payment.objects.bulk_create(payments)
+    payments_count += len(payments)
+    # Платежи записаны в обход сигналов: переносим статусы в карты оплативших, как при импорте
+    for month_start in get_month_starts(months):
+        update_paid_statuses(user_ids, month_start.year, month_start.month)
+
+    return {
+        'members': members,
+        'roots': roots,
+        'first_tree_id': first_tree_id,
+        'max_level': max(levels) if levels else 0,
+        'paths': paths_count,
+        'payments': payments_count,
+        'profile_ids': profile_ids,
+    }
+
+
+def measure(func):
+    # Время, количество запросов и пиковая память Python (tracemalloc сам замедляет выполнение)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'queries': len(queries),
+        'peak_memory': peak,
+    }
@@ -0,0 +1,307 @@
+from datetime import date
+from django.db import transaction
+from django.db.models import (
+    Count,
+    F,
+)
+from dashboard.models import (
+    Profile,
+    Payment,
+    MonthlyBonus,
+    ReferralPath,
+    month_range,
+)
+from dashboard.tree import get_ancestor_paths
+from dashboard.rules import rules
+from dashboard.paid_members import (
+    get_paid_status,
+    set_paid_statuses,
+    update_paid_statuses,
+)
+from dashboard.context_cache import (
+    get_cached_dashboard_information,
+    set_cached_dashboard_information,
+    invalidate_dashboard_information,
+    mark_leaderboard_stale,
+)
+
+
+# Количество пользователей в одной пачке массового пересчета
+MONTHLY_BONUS_CHUNK_SIZE = 5000
+
+
+def get_referral_counts(profile):
+    # Количество последователей на каждом уровне (без соединения с таблицей платежей)
+    rows = ReferralPath.objects.filter(
+        ancestor=profile,
+    ).order_by().values('depth').annotate(
+        referral_count=Count('id'),
+    )
+    referral_counts = {}
+    for row in rows:
+        referral_counts[row['depth']] = row['referral_count']
+    return referral_counts
+
+
+def get_bonus_referral_counts(profile_ids, year, month):
+    # Количество активных последователей каждого уровня для пачки пользователей.
+    # Один запрос: соединение таблицы связей по индексу (ancestor_id, depth) с платежами по индексу (user_id, paid, date)
+    start, end = month_range(year, month)
+    rows = ReferralPath.objects.filter(
+        ancestor_id__in=profile_ids,
+        descendant__user__payment__paid=True,
+        descendant__user__payment__date__gte=start,
+        descendant__user__payment__date__lt=end,
+    ).order_by().values('ancestor_id', 'depth').annotate(
+        bonus_referral_count=Count('descendant_id', distinct=True),
+    )
+    counts = {}
+    for row in rows:
+        counts.setdefault(row['ancestor_id'], {})[row['depth']] = row['bonus_referral_count']
+    return counts
+
+
+def get_monthly_bonus_values(level_counts, parent_id):
+    # Поля записи "MonthlyBonus" по количеству активных последователей каждого уровня
+    return rules.get_monthly_values(level_counts, bool(parent_id))
+
+
+def refresh_monthly_bonuses(profile_ids, year, month):
+    # Пересчитываем записи "MonthlyBonus" только для указанных пользователей
+    period = date(year, month, 1)
+    profiles = list(Profile.objects.filter(id__in=profile_ids).order_by().values_list('id', 'parent_id'))
+    counts = get_bonus_referral_counts([profile_id for profile_id, parent_id in profiles], year, month)
+    monthly_bonuses = {}
+    for profile_id, parent_id in profiles:
+        monthly_bonuses[profile_id], created = MonthlyBonus.objects.update_or_create(
+            profile_id=profile_id,
+            period=period,
+            defaults=get_monthly_bonus_values(counts.get(profile_id, {}), parent_id),
+        )
+    return monthly_bonuses
+
+
+def create_monthly_bonuses(profile_ids, year, month):
+    # Создаем недостающие записи "MonthlyBonus", не перезаписывая существующие: {id: (запись, создана ли)}.
+    # Если запись успел создать другой процесс, get_or_create дождется его и вернет ее, а не затрет своими числами
+    period = date(year, month, 1)
+    profiles = list(Profile.objects.filter(id__in=profile_ids).order_by().values_list('id', 'parent_id'))
+    counts = get_bonus_referral_counts([profile_id for profile_id, parent_id in profiles], year, month)
+    monthly_bonuses = {}
+    for profile_id, parent_id in profiles:
+        monthly_bonuses[profile_id] = MonthlyBonus.objects.get_or_create(
+            profile_id=profile_id,
+            period=period,
+            defaults=get_monthly_bonus_values(counts.get(profile_id, {}), parent_id),
+        )
+    return monthly_bonuses
+
+
+def rebuild_monthly_bonuses(profile_ids, year, month, chunk_size=MONTHLY_BONUS_CHUNK_SIZE):
+    # Массовый пересчет записей "MonthlyBonus": пачками, без запроса на каждого пользователя
+    period = date(year, month, 1)
+    profile_ids = list(profile_ids)
+    for start in range(0, len(profile_ids), chunk_size):
+        profiles = list(
+            Profile.objects.filter(id__in=profile_ids[start:start + chunk_size]).order_by().values_list('id', 'parent_id')
+        )
+        counts = get_bonus_referral_counts([profile_id for profile_id, parent_id in profiles], year, month)
+        with transaction.atomic():
+            MonthlyBonus.objects.filter(
+                profile_id__in=[profile_id for profile_id, parent_id in profiles],
+                period=period,
+            ).delete()
+            MonthlyBonus.objects.bulk_create([
+                MonthlyBonus(
+                    profile_id=profile_id,
+                    period=period,
+                    **get_monthly_bonus_values(counts.get(profile_id, {}), parent_id)
+                )
+                for profile_id, parent_id in profiles
+            ])
+
+
+def refresh_payments_monthly_bonuses(user_ids, year, month, chunk_size=MONTHLY_BONUS_CHUNK_SIZE):
+    # Платежи изменены массово (импорт, действие в админке) в обход сигналов "Payment":
+    # пересчитываем уже созданные записи предков этих пользователей и сбрасываем кэш панели
+    user_ids = list(user_ids)
+    period = date(year, month, 1)
+    profile_ids = set()
+    ancestor_ids = set()
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        profile_ids.update(Profile.objects.filter(user_id__in=chunk).values_list('id', flat=True))
+        ancestor_ids.update(
+            ReferralPath.objects.filter(descendant__user_id__in=chunk).order_by().values_list('ancestor_id', flat=True)
+        )
+    # Записи, которых еще нет, будут рассчитаны при первом обращении
+    ancestor_ids = list(ancestor_ids)
+    existing_ids = []
+    for start in range(0, len(ancestor_ids), chunk_size):
+        existing_ids.extend(MonthlyBonus.objects.filter(
+            profile_id__in=ancestor_ids[start:start + chunk_size],
+            period=period,
+        ).values_list('profile_id', flat=True))
+    rebuild_monthly_bonuses(existing_ids, year, month, chunk_size)
+    update_paid_statuses(user_ids, year, month)
+    # Кэш сбрасываем после фиксации транзакции, иначе его успеют заполнить старыми данными
+    invalidated_ids = profile_ids | set(ancestor_ids)
+    transaction.on_commit(lambda: invalidate_dashboard_information(invalidated_ids, year, month))
+    transaction.on_commit(lambda: mark_leaderboard_stale(year, month))
+
+
+def get_ancestors_depths(profile):
+    # Предки пользователя до четвертого уровня: пары (id предка, уровень пользователя относительно предка)
+    return list(get_ancestor_paths(profile))
+
+
+def propagate_paying_change(profile, year, month, delta):
+    # Пользователь начал (delta = 1) или перестал (delta = -1) быть активным в месяце.
+    # Атомарно меняем счетчики только у его предков до четвертого уровня
+    rules.check_price()
+    period = date(year, month, 1)
+    with transaction.atomic():
+        ancestors = get_ancestors_depths(profile)
+        # Записей еще нет - создаем их по базе, где изменение уже сохранено. Запись, которую создал
+        # другой процесс, его не учитывает (транзакция еще не зафиксирована), к ней прибавляем изменение
+        existing_ids = set(MonthlyBonus.objects.filter(
+            profile_id__in=[ancestor_id for ancestor_id, depth in ancestors],
+            period=period,
+        ).values_list('profile_id', flat=True))
+        created_ids = set(
+            profile_id for profile_id, (monthly_bonus, created) in create_monthly_bonuses(
+                [ancestor_id for ancestor_id, depth in ancestors if ancestor_id not in existing_ids], year, month,
+            ).items() if created
+        )
+        for ancestor_id, depth in ancestors:
+            if ancestor_id in created_ids:
+                continue
+            level = rules.get_level(depth)
+            level_amount = delta * level.amount
+            MonthlyBonus.objects.filter(profile_id=ancestor_id, period=period).update(**{
+                level.name + '_level_bonus_referral_count': F(level.name + '_level_bonus_referral_count') + delta,
+                level.name + '_level_amount': F(level.name + '_level_amount') + level_amount,
+                'month_amount': F('month_amount') + level_amount,
+            })
+
+
+def update_payment_monthly_bonuses(payment_id, old_payment, new_payment):
+    # old_payment и new_payment - тройки (user_id, paid, date) до и после изменения, None если платежа не было.
+    # Платеж могут передать другому пользователю: статус меняется у обоих
+    changes = set()
+    for payment in (old_payment, new_payment):
+        if payment and payment[1]:
+            changes.add((payment[0], payment[2].year, payment[2].month))
+
+    for user_id, year, month in changes:
+        was_paid = bool(old_payment and old_payment[1] and (
+            old_payment[0], old_payment[2].year, old_payment[2].month) == (user_id, year, month))
+        is_paid = bool(new_payment and new_payment[1] and (
+            new_payment[0], new_payment[2].year, new_payment[2].month) == (user_id, year, month))
+        if was_paid == is_paid:
+            continue
+        # Если у пользователя есть другой оплаченный платеж за месяц, его статус не изменился
+        if Payment.objects.filter(
+            user_id=user_id,
+        ).paid_in_period(year, month).exclude(id=payment_id).exists():
+            continue
+        # Карту оплативших меняем после фиксации: до нее другие запросы видят прежний статус в базе
+        transaction.on_commit(
+            lambda user_id=user_id, year=year, month=month, is_paid=is_paid: set_paid_statuses(
+                {user_id: is_paid}, year, month,
+            )
+        )
+        try:
+            profile = Profile.objects.get(user_id=user_id)
+        except Profile.DoesNotExist:
+            continue
+        propagate_paying_change(profile, year, month, 1 if is_paid else -1)
+        # Сбрасываем кэш панели у пользователя (статус оплаты) и у его предков (бонусы) после фиксации транзакции
+        invalidated_ids = [profile.id] + [ancestor_id for ancestor_id, depth in get_ancestors_depths(profile)]
+        transaction.on_commit(
+            lambda invalidated_ids=invalidated_ids, year=year, month=month: invalidate_dashboard_information(
+                invalidated_ids, year, month,
+            )
+        )
+        transaction.on_commit(lambda year=year, month=month: mark_leaderboard_stale(year, month))
+
+
+def update_parent_monthly_bonuses(profile, ancestor_ids):
+    # Пользователь сменил родителя: пересчитываем его запись (процент от родителя),
+    # а если в его ветке есть активные последователи - записи старых и новых предков (ancestor_ids)
+    year = date.today().year
+    month = date.today().month
+    profile_ids = [profile.id]
+    if not profile.is_leaf_node() or get_payment_status(profile.user_id, year, month):
+        profile_ids.extend(ancestor_ids)
+    refresh_monthly_bonuses(profile_ids, year, month)
+    mark_leaderboard_stale(year, month)
+
+
+def get_monthly_bonus(profile, year, month):
+    # Запись из таблицы бонусов; если ее еще нет, рассчитываем и сохраняем
+    try:
+        return MonthlyBonus.objects.get(profile=profile, period=date(year, month, 1))
+    except MonthlyBonus.DoesNotExist:
+        return create_monthly_bonuses([profile.id], year, month)[profile.id][0]
+
+
+def get_payment_status(user_id, year, month):
+    # Статус оплаты пользователя за месяц: из карты оплативших в Redis, без нее - из базы
+    return get_paid_status(user_id, year, month)
+
+
+def get_month_information(profile, year, month):
+    monthly_bonus = get_monthly_bonus(profile, year, month)
+    referral_counts = get_referral_counts(profile)
+
+    # Процент от того, кто пригласил пользователя
+    information = {
+        'amount_from_parent': monthly_bonus.amount_from_parent,
+    }
+
+    # Количество последователей, активных последователей и полученная сумма денег с каждого уровня
+    referrals_count = 0
+    bonus_referral_count = 0
+    for level, name, percent, amount in rules.levels:
+        level_referral_count = referral_counts.get(level, 0)
+        level_bonus_referral_count = getattr(monthly_bonus, name + '_level_bonus_referral_count')
+
+        information[name + '_level_referral_count'] = level_referral_count
+        information[name + '_level_bonus_referral_count'] = level_bonus_referral_count
+        information[name + '_level_amount'] = getattr(monthly_bonus, name + '_level_amount')
+
+        referrals_count += level_referral_count
+        bonus_referral_count += level_bonus_referral_count
+
+    information['referrals_count'] = referrals_count
+    information['bonus_referral_count'] = bonus_referral_count
+
+    # Счет пользователя за текущий месяц
+    information['current_month_amount'] = monthly_bonus.month_amount
+
+    # Статус оплаты самого пользователя
+    information['payment_status'] = get_payment_status(profile.user_id, year, month)
+
+    return information
+
+
+def get_bonus_information(profile, year=None, month=None):
+    # Текущий год и месяц при обращении к страницы
+    if year is None or month is None:
+        year = date.today().year
+        month = date.today().month
+
+    # Бонусы за месяц берем из кэша; он сбрасывается при изменении платежей и дерева
+    information = get_cached_dashboard_information(profile.id, year, month)
+    if information is None:
+        information = get_month_information(profile, year, month)
+        set_cached_dashboard_information(profile.id, year, month, information)
+
+    # Накопления за предыдущие месяцы (не кэшируются: меняются при закрытии месяца)
+    information['last_month_amount'] = profile.amount
+
+    # Общие накопления
+    information['amount'] = information['current_month_amount'] + (profile.amount or 0)
+
+    return information
@@ -0,0 +1,53 @@
+import time
+from django.core.cache import cache
+
+
+# Бонусы за месяц, показываемые в панели пользователя: ключ по id профиля и месяцу
+DASHBOARD_INFORMATION_KEY = 'dashboard_information:%s:%s-%s'
+
+# Страховочное время жизни: кэш сбрасывается событиями, но не живет дольше часа
+DASHBOARD_INFORMATION_TIMEOUT = 60 * 60
+
+# Версия данных пользователя (для ETag): увеличивается при каждом сбросе кэша
+DASHBOARD_VERSION_KEY = 'dashboard_version:%s'
+DASHBOARD_VERSION_TIMEOUT = 60 * 60 * 24 * 31
+
+
+def get_cached_dashboard_information(profile_id, year, month):
+    return cache.get(DASHBOARD_INFORMATION_KEY % (profile_id, year, month))
+
+
+def set_cached_dashboard_information(profile_id, year, month, information):
+    cache.set(DASHBOARD_INFORMATION_KEY % (profile_id, year, month), information, DASHBOARD_INFORMATION_TIMEOUT)
+
+
+def invalidate_dashboard_information(profile_ids, year, month):
+    # Одним запросом к кэшу: удаленная версия создается заново при следующем чтении (новое время),
+    # поэтому сброс пачки пользователей после импорта платежей не зависит от ее размера
+    keys = []
+    for profile_id in profile_ids:
+        keys.append(DASHBOARD_INFORMATION_KEY % (profile_id, year, month))
+        keys.append(DASHBOARD_VERSION_KEY % profile_id)
+    cache.delete_many(keys)
+
+
+def get_dashboard_version(profile_id):
+    # Начальное значение - текущее время, чтобы после вытеснения ключа версия не повторилась
+    cache.add(DASHBOARD_VERSION_KEY % profile_id, int(time.time() * 1000), DASHBOARD_VERSION_TIMEOUT)
+    return cache.get(DASHBOARD_VERSION_KEY % profile_id)
+
+
+# Рейтинги месяца устарели: платежи или дерево менялись после последнего пересчета
+LEADERBOARD_STALE_KEY = 'leaderboard_stale:%s-%s'
+LEADERBOARD_STALE_TIMEOUT = 60 * 60 * 24 * 62
+
+
+def mark_leaderboard_stale(year, month):
+    cache.set(LEADERBOARD_STALE_KEY % (year, month), True, LEADERBOARD_STALE_TIMEOUT)
+
+
+def pop_leaderboard_stale(year, month):
+    # Отметка снимается до пересчета: изменения во время него запланируют следующий
+    stale = cache.get(LEADERBOARD_STALE_KEY % (year, month)) is not None
+    cache.delete(LEADERBOARD_STALE_KEY % (year, month))
+    return stale
@@ -0,0 +1,139 @@
+import csv
+import json
+from datetime import date
+from dashboard.bonus import (
+    get_bonus_referral_counts,
+    get_monthly_bonus_values,
+)
+from dashboard.models import (
+    Payment,
+    Profile,
+)
+from dashboard.rules import rules
+
+
+# Форматы выгрузки ведомости бонусов
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+# Количество строк, для которых бонусы и пакеты считаются одной пачкой запросов
+EXPORT_CHUNK_SIZE = 5000
+
+EXPORT_COLUMNS = (
+    ['username', 'last_name', 'first_name', 'middle_name', 'phone_number', 'parent', 'tree_id', 'paid'] +
+    [level.name + '_level_' + column for level in rules.levels for column in ('bonus_referral_count', 'amount')] +
+    ['amount_from_parent', 'month_amount', 'previous_amount', 'package', 'package_remaining']
+)
+
+# Накопления и пакет известны только на сегодня: в ведомости за прошлые месяцы этих колонок нет
+CURRENT_PERIOD_COLUMNS = ('previous_amount', 'package', 'package_remaining')
+
+
+def is_current_period(year, month):
+    return (year, month) == (date.today().year, date.today().month)
+
+
+def get_export_columns(year, month):
+    if is_current_period(year, month):
+        return EXPORT_COLUMNS
+    return [column for column in EXPORT_COLUMNS if column not in CURRENT_PERIOD_COLUMNS]
+
+
+def parse_period(value):
+    # Месяц в виде ГГГГ-ММ
+    try:
+        year, month = value.split('-')
+        return date(int(year), int(month), 1)
+    except ValueError:
+        raise ValueError('Неверный месяц "%s", ожидается ГГГГ-ММ' % value)
+
+
+def iter_bonus_statements(year, month, tree_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # Ведомость бонусов за месяц: строка на участника по порядку id.
+    # Профили читаются курсором (на PostgreSQL - серверным), бонусы считаются по пачке профилей
+    # по таблице связей, как в refresh_monthly_bonuses: память не растет с количеством участников
+    profiles = Profile.objects.order_by('id')
+    if tree_id is not None:
+        profiles = profiles.filter(tree_id=tree_id)
+    rows = profiles.values_list(
+        'id',
+        'user_id',
+        'user__username',
+        'last_name',
+        'first_name',
+        'middle_name',
+        'phone_number',
+        'parent__user__username',
+        'tree_id',
+        'amount',
+    ).iterator()
+
+    current_period = is_current_period(year, month)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            for statement in get_chunk_statements(chunk, year, month, current_period):
+                yield statement
+            chunk = []
+    for statement in get_chunk_statements(chunk, year, month, current_period):
+        yield statement
+
+
+def get_chunk_statements(chunk, year, month, current_period):
+    if not chunk:
+        return []
+    counts = get_bonus_referral_counts([row[0] for row in chunk], year, month)
+    paid_user_ids = set(Payment.objects.filter(
+        user_id__in=[row[1] for row in chunk],
+    ).paid_user_ids(year, month))
+    values = [get_monthly_bonus_values(counts.get(row[0], {}), row[7] is not None) for row in chunk]
+    if current_period:
+        # Накопления текущего месяца еще не перенесены в "amount", поэтому пакет считаем по их сумме, как на панели
+        packages = rules.evaluate_many((row[9] or 0) + value['month_amount'] for row, value in zip(chunk, values))
+    else:
+        packages = [None] * len(chunk)
+    statements = []
+    for row, value, package in zip(chunk, values, packages):
+        profile_id, user_id, username, last_name, first_name, middle_name, phone_number, parent, tree_id, amount = row
+        statement = {
+            'username': username,
+            'last_name': last_name,
+            'first_name': first_name,
+            'middle_name': middle_name,
+            'phone_number': str(phone_number or ''),
+            'parent': parent,
+            'tree_id': tree_id,
+            'paid': user_id in paid_user_ids,
+        }
+        statement.update(value)
+        if package is not None:
+            statement['previous_amount'] = amount
+            statement['package'] = package.tier.name if package.tier else rules.tiers[-1].name
+            statement['package_remaining'] = package.remaining
+        statements.append(statement)
+    return statements
+
+
+class Echo(object):
+    # Буфер для csv.writer, который сразу возвращает записанную строку
+    def write(self, value):
+        return value
+
+
+def iter_csv_lines(statements, columns=EXPORT_COLUMNS):
+    # BOM нужен Excel, чтобы прочитать кириллицу
+    writer = csv.writer(Echo())
+    yield '\ufeff' + writer.writerow(columns)
+    for statement in statements:
+        yield writer.writerow([statement[column] for column in columns])
+
+
+def iter_jsonl_lines(statements):
+    for statement in statements:
+        yield json.dumps(statement, ensure_ascii=False) + '\n'
+
+
+def iter_export_lines(statements, export_format, columns=EXPORT_COLUMNS):
+    if export_format == 'csv':
+        return iter_csv_lines(statements, columns)
+    return iter_jsonl_lines(statements)
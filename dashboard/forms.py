@@ -116,3 +116,11 @@ class SpecifyParentForm(forms.Form):
             'id': 'email',
             'class': 'form-control',
         }
+
+
+class PaymentImportForm(forms.Form):
+    csv_file = forms.FileField(
+        label="CSV-файл",
+        help_text="Строки: логин или email, дата (ГГГГ-ММ-ДД), оплачен (необязательно, по умолчанию 1)",
+        required=True,
+    )
@@ -0,0 +1,202 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.template.backends.django import (
+    DjangoTemplates,
+    Template,
+)
+from BonusDesk.settings import (
+    REQUEST_INSTRUMENTATION,
+    REQUEST_INSTRUMENTATION_LOG_INTERVAL,
+    QUERY_BUDGETS,
+    QUERY_BUDGETS_STRICT,
+)
+
+
+logger = logging.getLogger('dashboard.instrumentation')
+
+# Сколько страниц показывать в сводной строке журнала
+AGGREGATE_LOG_VIEWS = 10
+
+# Нормализация SQL до отпечатка: литералы и списки IN заменяются, чтобы одинаковые запросы совпадали
+STRING_LITERAL_RE = re.compile(r"'(?:''|[^'])*'")
+NUMBER_LITERAL_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST_RE = re.compile(r'IN \((?:\?, )*\?\)')
+
+
+# Время шаблонов текущего запроса (в потоке, который его обрабатывает)
+request_state = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class InstrumentedTemplate(Template):
+    # Время рендеринга любого шаблона: TemplateResponse и render_to_string в JSON-ответах.
+    # Вложенный рендеринг (render_to_string внутри шаблона) входит во время внешнего
+
+    def render(self, context=None, request=None):
+        depth = getattr(request_state, 'template_depth', None)
+        if depth is None:
+            return super(InstrumentedTemplate, self).render(context, request)
+        request_state.template_depth = depth + 1
+        start = time.time()
+        try:
+            return super(InstrumentedTemplate, self).render(context, request)
+        finally:
+            request_state.template_depth = depth
+            if depth == 0:
+                request_state.template_time += time.time() - start
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(super(InstrumentedDjangoTemplates, self).from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super(InstrumentedDjangoTemplates, self).get_template(template_name).template, self)
+
+
+def get_query_fingerprint(sql):
+    sql = STRING_LITERAL_RE.sub('?', sql)
+    sql = NUMBER_LITERAL_RE.sub('?', sql)
+    return IN_LIST_RE.sub('IN (...)', sql)
+
+
+def get_queries_stats(queries):
+    # Количество запросов, суммарное время и повторяющиеся (с точностью до параметров) запросы
+    fingerprints = Counter(get_query_fingerprint(query['sql']) for query in queries)
+    return {
+        'queries': len(queries),
+        'sql_time': sum(float(query['time']) for query in queries),
+        'duplicates': {fingerprint: count for fingerprint, count in fingerprints.items() if count > 1},
+    }
+
+
+def check_query_budget(view_name, queries_count, duplicates=None, budget=None):
+    # Бюджет запросов страницы из QUERY_BUDGETS (по имени url), если не задан явно
+    if budget is None:
+        budget = QUERY_BUDGETS.get(view_name)
+    if budget is None or queries_count <= budget:
+        return None
+    message = '%s: %s SQL-запросов при бюджете %s' % (view_name, queries_count, budget)
+    if duplicates:
+        message += '; повторяются: %s' % '; '.join(
+            '%s x %s' % (count, fingerprint) for fingerprint, count in sorted(duplicates.items(), key=lambda item: -item[1])
+        )
+    return message
+
+
+class RequestStatsAggregator(object):
+    # Сводка по страницам за интервал: одна строка в журнал раз в REQUEST_INSTRUMENTATION_LOG_INTERVAL секунд
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.views = {}
+
+    def add(self, view_name, stats):
+        with self.lock:
+            view = self.views.setdefault(view_name, {
+                'requests': 0,
+                'total_time': 0.0,
+                'queries': 0,
+                'max_queries': 0,
+                'sql_time': 0.0,
+                'duplicates': 0,
+                'template_time': 0.0,
+                'size': 0,
+            })
+            view['requests'] += 1
+            view['total_time'] += stats['total_time']
+            view['queries'] += stats['queries']
+            view['max_queries'] = max(view['max_queries'], stats['queries'])
+            view['sql_time'] += stats['sql_time']
+            view['duplicates'] += sum(count - 1 for count in stats['duplicates'].values())
+            view['template_time'] += stats['template_time']
+            view['size'] += stats['size'] or 0
+            if time.time() - self.started < self.interval:
+                return
+            views = self.views
+            self.views = {}
+            self.started = time.time()
+        logger.info(self.format(views))
+
+    def format(self, views):
+        lines = []
+        for view_name, view in sorted(views.items(), key=lambda item: -item[1]['total_time'])[:AGGREGATE_LOG_VIEWS]:
+            requests = view['requests']
+            lines.append(
+                '%s: n=%s avg=%.0fms sql=%.1fq/%.0fms max=%sq dup=%.1f tpl=%.0fms size=%.0fKB' % (
+                    view_name,
+                    requests,
+                    view['total_time'] * 1000 / requests,
+                    view['queries'] / requests,
+                    view['sql_time'] * 1000 / requests,
+                    view['max_queries'],
+                    view['duplicates'] / requests,
+                    view['template_time'] * 1000 / requests,
+                    view['size'] / 1024 / requests,
+                )
+            )
+        return 'requests=%s | %s' % (sum(view['requests'] for view in views.values()), ' | '.join(lines))
+
+
+aggregator = RequestStatsAggregator(REQUEST_INSTRUMENTATION_LOG_INTERVAL)
+
+
+class RequestInstrumentationMiddleware(object):
+    # Должен стоять первым в MIDDLEWARE: тогда в замер попадают запросы и шаблоны остальных middleware.
+    # Время шаблонов считает InstrumentedDjangoTemplates (BACKEND в TEMPLATES)
+
+    def __init__(self, get_response):
+        if not REQUEST_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_state.template_time = 0.0
+        request_state.template_depth = 0
+        force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        connection.queries_log.clear()
+        start = time.time()
+        try:
+            response = self.get_response(request)
+        finally:
+            connection.force_debug_cursor = force_debug_cursor
+            request_state.template_depth = None
+        total_time = time.time() - start
+
+        stats = get_queries_stats(connection.queries_log)
+        stats['total_time'] = total_time
+        stats['template_time'] = request_state.template_time
+        stats['size'] = None if response.streaming else len(response.content)
+        response.instrumentation = stats
+
+        timings = [
+            'sql;dur=%.1f;desc="%s queries"' % (stats['sql_time'] * 1000, stats['queries']),
+            'dup;desc="%s duplicated"' % sum(count - 1 for count in stats['duplicates'].values()),
+            'tpl;dur=%.1f' % (stats['template_time'] * 1000),
+        ]
+        if stats['size'] is not None:
+            timings.append('size;desc="%s bytes"' % stats['size'])
+        timings.append('total;dur=%.1f' % (total_time * 1000))
+        response['Server-Timing'] = ', '.join(timings)
+
+        view_name = request.resolver_match.view_name if request.resolver_match else None
+        if view_name:
+            aggregator.add(view_name, stats)
+            message = check_query_budget(view_name, stats['queries'], stats['duplicates'])
+            if message:
+                if QUERY_BUDGETS_STRICT:
+                    raise QueryBudgetExceeded(message)
+                logger.warning(message)
+        return response
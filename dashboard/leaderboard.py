@@ -0,0 +1,95 @@
+from datetime import date
+import numpy
+from django.db import transaction
+from dashboard.models import LeaderboardEntry
+from dashboard.population import get_population_bonuses
+from dashboard.rules import rules
+
+
+# Количество строк в одном INSERT при пересчете рейтингов
+LEADERBOARD_BATCH_SIZE = 5000
+
+# Сколько первых мест отдавать по умолчанию и максимум
+LEADERBOARD_SIZE = 10
+LEADERBOARD_MAX_SIZE = 100
+
+
+def get_board_values(population):
+    # Значение каждого рейтинга у всех участников. Бонусы с уровня пропорциональны числу активных
+    # последователей этого уровня, поэтому отдельный рейтинг по сумме с уровня не нужен
+    boards = [
+        ('month_amount', population['month_amounts']),
+        ('bonus_referral_count', population['level_counts'].sum(axis=0)),
+    ]
+    for depth, level in enumerate(rules.levels):
+        boards.append((level.name + '_level_bonus_referral_count', population['level_counts'][depth]))
+    return boards
+
+
+def get_ranks(values):
+    # Места по убыванию; у равных значений одно место, следующее - с пропуском (1, 2, 2, 4)
+    descending = -values
+    return numpy.searchsorted(descending, descending, side='left') + 1
+
+
+def refresh_leaderboards(year, month, population=None, batch_size=LEADERBOARD_BATCH_SIZE):
+    # Полный пересчет рейтингов месяца одним проходом по лесу. В рейтинг попадают только ненулевые значения.
+    # Старые записи заменяются в одной транзакции: читающие видят прежние рейтинги до ее фиксации
+    period = date(year, month, 1)
+    if population is None:
+        population = get_population_bonuses(year, month)
+    profile_ids = population['profile_ids']
+    entries_count = 0
+    with transaction.atomic():
+        LeaderboardEntry.objects.filter(period=period).delete()
+        for board, values in get_board_values(population):
+            ranked = values > 0
+            board_ids = profile_ids[ranked]
+            board_values = values[ranked]
+            # По убыванию значения, при равенстве - по id
+            order = numpy.lexsort((board_ids, -board_values))
+            board_ids = board_ids[order].tolist()
+            board_values = board_values[order]
+            ranks = get_ranks(board_values).tolist()
+            board_values = board_values.tolist()
+            for start in range(0, len(board_ids), batch_size):
+                LeaderboardEntry.objects.bulk_create([
+                    LeaderboardEntry(
+                        period=period,
+                        board=board,
+                        profile_id=profile_id,
+                        value=value,
+                        rank=rank,
+                    )
+                    for profile_id, value, rank in zip(
+                        board_ids[start:start + batch_size],
+                        board_values[start:start + batch_size],
+                        ranks[start:start + batch_size],
+                    )
+                ])
+            entries_count += len(board_ids)
+    return entries_count
+
+
+def get_leaderboard_top(year, month, board, limit=LEADERBOARD_SIZE):
+    # Первые места: диапазон индекса (period, board, rank)
+    return [
+        {
+            'rank': rank,
+            'username': username,
+            'value': value,
+        }
+        for rank, username, value in LeaderboardEntry.objects.filter(
+            period=date(year, month, 1),
+            board=board,
+        ).order_by('rank', 'profile_id').values_list('rank', 'profile__user__username', 'value')[:limit]
+    ]
+
+
+def get_leaderboard_rank(profile, year, month, board):
+    # Место пользователя: одна строка по уникальному индексу (period, board, profile); None - значение нулевое
+    return LeaderboardEntry.objects.filter(
+        period=date(year, month, 1),
+        board=board,
+        profile=profile,
+    ).values('rank', 'value').first()
@@ -0,0 +1,121 @@
+from datetime import date
+from django.contrib.auth.models import User
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from django.db import transaction
+from django.db.models import F
+from django.test import RequestFactory
+from dashboard.benchmark import (
+    generate_referral_forest,
+    measure,
+)
+from dashboard.context_cache import invalidate_dashboard_information
+from dashboard.members import get_request_profile
+from dashboard.models import (
+    Payment,
+    Profile,
+)
+from dashboard.tasks import amount_counting
+from dashboard.views import (
+    DashboardView,
+    search_user_information,
+    specify_parent,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Замер DashboardView, search_user_information, specify_parent и ежемесячного начисления '
+        'на сгенерированных лесах разного размера: время, количество запросов, пиковая память Python. '
+        'Данные создаются в транзакции и откатываются (кроме --keep)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+        parser.add_argument('--branching', type=int, default=5)
+        parser.add_argument('--skew', type=float, default=0.5)
+        parser.add_argument('--payment-ratio', type=float, default=0.7)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Не откатывать сгенерированные данные (без замеров specify_parent и amount_counting)',
+        )
+
+    def handle(self, *args, **options):
+        if any(size < 2 for size in options['sizes']):
+            raise CommandError('Размер леса должен быть не меньше 2')
+        if options['keep']:
+            self.stdout.write(self.style.WARNING('С --keep specify_parent и amount_counting не замеряются'))
+        self.stdout.write('%10s  %-36s %10s %8s %12s' % ('Участников', 'Точка входа', 'Время, с', 'Запросов', 'Память, МБ'))
+        for size in options['sizes']:
+            with transaction.atomic():
+                profile_ids = self.benchmark(size, options)
+                transaction.set_rollback(not options['keep'])
+            if not options['keep']:
+                # Откаченные данные могли попасть в кэш панели
+                invalidate_dashboard_information(profile_ids, date.today().year, date.today().month)
+
+    def benchmark(self, size, options):
+        forest = generate_referral_forest(
+            members=size,
+            branching=options['branching'],
+            skew=options['skew'],
+            payment_ratio=options['payment_ratio'],
+            months=2,
+            seed=options['seed'],
+            prefix='benchmark%s_' % size,
+        )
+
+        # Самая большая ветка и последний добавленный участник (лист), которого переносим в нее
+        top_profile = Profile.objects.filter(
+            tree_id__gte=forest['first_tree_id'],
+            level=0,
+        ).select_related('user').order_by(F('lft') - F('rght')).first()
+        leaf_profile = Profile.objects.select_related('user').get(id=forest['profile_ids'][-1])
+        if not Payment.objects.filter(user=top_profile.user).paid_in_period(date.today().year, date.today().month).exists():
+            Payment.objects.create(user=top_profile.user, paid=True)
+        superuser = User(username='benchmark', is_superuser=True)
+        factory = RequestFactory()
+
+        def dashboard():
+            request = factory.get('/dashboard/')
+            request.user = top_profile.user
+            # Как MemberMiddleware (RequestFactory не вызывает middleware)
+            request.profile = get_request_profile(request)
+            DashboardView.as_view()(request).render()
+
+        def search():
+            request = factory.post('/dashboard/search_user_information/%s/' % top_profile.user.username)
+            request.user = superuser
+            search_user_information(request, top_profile.user.username)
+
+        def move():
+            request = factory.post('/dashboard/specify_parent/', {'email': top_profile.user.email})
+            request.user = leaf_profile.user
+            specify_parent(request)
+
+        def rollover():
+            # Только деревья сгенерированного леса: остальные профили не блокируются и не получают начислений
+            amount_counting(date.today().year, date.today().month, tree_ids=list(range(
+                forest['first_tree_id'], forest['first_tree_id'] + forest['roots'],
+            )))
+
+        invalidate_dashboard_information([top_profile.id], date.today().year, date.today().month)
+        entry_points = [
+            ('DashboardView (без кэша)', dashboard),
+            ('DashboardView (из кэша)', dashboard),
+            ('search_user_information', search),
+        ]
+        # Перенос участника и начисление за месяц меняют данные: с --keep они остались бы в базе
+        if not options['keep']:
+            entry_points.append(('specify_parent', move))
+            entry_points.append(('amount_counting', rollover))
+        for name, func in entry_points:
+            result = measure(func)
+            self.stdout.write('%10s  %-36s %10.3f %8s %12.1f' % (
+                size, name, result['seconds'], result['queries'], result['peak_memory'] / 1024 / 1024,
+            ))
+        return forest['profile_ids']
@@ -0,0 +1,83 @@
+import os
+from multiprocessing import Pool
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from django.db import connections
+from dashboard.models import Profile
+from dashboard.tree import (
+    check_tree,
+    repair_tree,
+)
+
+
+def process_tree(arguments):
+    # Задача пула: одно дерево. Возвращает (tree_id, несоответствий, состояние после обработки)
+    tree_id, repair = arguments
+    error_count = check_tree(tree_id)
+    if not error_count:
+        return tree_id, 0, 'ok'
+    if not repair:
+        return tree_id, error_count, 'broken'
+    try:
+        remaining_count = repair_tree(tree_id)
+    except RuntimeError:
+        # Несколько корней с одним tree_id: частичное перестроение невозможно
+        return tree_id, error_count, 'failed'
+    if remaining_count is None:
+        return tree_id, error_count, 'busy'
+    return tree_id, error_count, 'rebuilt' if not remaining_count else 'failed'
+
+
+class Command(BaseCommand):
+    help = 'Проверка полей lft/rght/level каждого дерева и перестроение только поврежденных деревьев'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tree', type=int, nargs='+', help='Деревья (tree_id), по умолчанию все')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Количество процессов')
+        parser.add_argument('--dry-run', action='store_true', help='Только проверка, без перестроения')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers должно быть больше нуля')
+        tree_ids = options['tree'] or list(
+            Profile.objects.order_by('tree_id').values_list('tree_id', flat=True).distinct()
+        )
+        tasks = [(tree_id, not options['dry_run']) for tree_id in tree_ids]
+
+        if options['workers'] == 1:
+            results = [process_tree(task) for task in tasks]
+        else:
+            # Дочерние процессы открывают свои соединения с базой, унаследованные закрываем до их запуска
+            connections.close_all()
+            with Pool(options['workers']) as pool:
+                results = list(pool.imap_unordered(process_tree, tasks))
+
+        # Деревья, заблокированные при перестроении соседних (ветка между деревьями), проверяем еще раз
+        results = [
+            process_tree((tree_id, True)) if status == 'busy' else (tree_id, error_count, status)
+            for tree_id, error_count, status in results
+        ]
+
+        statuses = {}
+        for tree_id, error_count, status in sorted(results):
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 'rebuilt':
+                self.stdout.write('Дерево %s: несоответствий %s, перестроено' % (tree_id, error_count))
+            elif status == 'broken':
+                self.stdout.write(self.style.WARNING('Дерево %s: несоответствий %s' % (tree_id, error_count)))
+            elif status == 'busy':
+                self.stdout.write(self.style.WARNING('Дерево %s: перестраивается другим процессом' % tree_id))
+            elif status == 'failed':
+                self.stdout.write(self.style.ERROR(
+                    'Дерево %s: несоответствий %s, частичное перестроение не помогло, '
+                    'нужно Profile.objects.rebuild()' % (tree_id, error_count)
+                ))
+
+        summary = 'Деревьев: %s, целых: %s, перестроено: %s' % (
+            len(results), statuses.get('ok', 0), statuses.get('rebuilt', 0),
+        )
+        if statuses.get('broken') or statuses.get('failed'):
+            raise CommandError('%s, повреждено: %s' % (summary, statuses.get('broken', 0) + statuses.get('failed', 0)))
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,44 @@
+from datetime import date
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from dashboard.export import (
+    EXPORT_FORMATS,
+    parse_period,
+    get_export_columns,
+    iter_bonus_statements,
+    iter_export_lines,
+)
+
+
+class Command(BaseCommand):
+    help = 'Ведомость бонусов всех участников за месяц в CSV или JSONL (построчно, без загрузки в память)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', help='Месяц ГГГГ-ММ, по умолчанию текущий')
+        parser.add_argument('--tree', type=int, default=None, help='Только одно дерево (tree_id)')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--output', default='-', help='Путь к файлу, "-" - стандартный вывод')
+
+    def handle(self, *args, **options):
+        try:
+            period = parse_period(options['period']) if options['period'] else date.today().replace(day=1)
+        except ValueError as error:
+            raise CommandError(error)
+
+        lines = iter_export_lines(
+            iter_bonus_statements(period.year, period.month, options['tree']),
+            options['format'],
+            get_export_columns(period.year, period.month),
+        )
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        try:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                for line in lines:
+                    output.write(line)
+        except OSError as error:
+            raise CommandError(error)
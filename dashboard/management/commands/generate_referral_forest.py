@@ -0,0 +1,44 @@
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from django.db import transaction
+from dashboard.benchmark import generate_referral_forest
+
+
+class Command(BaseCommand):
+    help = 'Генерация воспроизводимого леса последователей с платежами (для разработки и замеров)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000, help='Количество участников')
+        parser.add_argument('--roots', type=int, default=None, help='Количество деревьев (по умолчанию 1 на 1000)')
+        parser.add_argument('--branching', type=int, default=5, help='Максимум прямых последователей у участника')
+        parser.add_argument('--skew', type=float, default=0.5, help='Перекос в глубину: от 0 (широкие) до 1 (глубокие)')
+        parser.add_argument('--payment-ratio', type=float, default=0.7, help='Доля оплативших за каждый месяц')
+        parser.add_argument('--months', type=int, default=1, help='Количество месяцев с платежами, включая текущий')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='member', help='Префикс логинов')
+
+    def handle(self, *args, **options):
+        if options['members'] < 1 or options['branching'] < 1 or options['months'] < 1:
+            raise CommandError('--members, --branching и --months должны быть больше нуля')
+        if not 0 <= options['skew'] <= 1 or not 0 <= options['payment_ratio'] <= 1:
+            raise CommandError('--skew и --payment-ratio должны быть от 0 до 1')
+        if options['roots'] is not None and not 1 <= options['roots'] <= options['members']:
+            raise CommandError('--roots должно быть от 1 до --members')
+
+        with transaction.atomic():
+            result = generate_referral_forest(
+                members=options['members'],
+                roots=options['roots'],
+                branching=options['branching'],
+                skew=options['skew'],
+                payment_ratio=options['payment_ratio'],
+                months=options['months'],
+                seed=options['seed'],
+                prefix=options['prefix'],
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Участников: %(members)s, деревьев: %(roots)s, глубина: %(max_level)s, '
+            'связей: %(paths)s, платежей: %(payments)s' % result
+        ))
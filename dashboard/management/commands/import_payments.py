@@ -0,0 +1,39 @@
+import io
+import sys
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from django.db import connection
+from dashboard.payment_import import (
+    PAYMENT_IMPORT_BATCH_SIZE,
+    import_payments,
+)
+
+
+class Command(BaseCommand):
+    help = 'Загрузка платежей из CSV: логин или email, дата (ГГГГ-ММ-ДД), оплачен (необязательно, по умолчанию 1)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='Путь к CSV-файлу, "-" - стандартный ввод')
+        parser.add_argument('--batch-size', type=int, default=PAYMENT_IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Импорт платежей использует COPY и работает только с PostgreSQL')
+
+        if options['csv_file'] == '-':
+            result = import_payments(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig'), options['batch_size'])
+        else:
+            try:
+                with open(options['csv_file'], encoding='utf-8-sig', newline='') as csv_file:
+                    result = import_payments(csv_file, options['batch_size'])
+            except OSError as error:
+                raise CommandError(error)
+
+        for line_number, message in result['errors']:
+            self.stderr.write('Строка %s: %s' % (line_number, message))
+        self.stdout.write(self.style.SUCCESS(
+            'Строк: %(rows)s, загружено: %(imported)s, создано платежей: %(created)s, '
+            'изменено: %(updated)s, ошибок: %(errors_count)s' % result
+        ))
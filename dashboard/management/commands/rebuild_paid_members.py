@@ -0,0 +1,31 @@
+from datetime import date
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from dashboard.export import parse_period
+from dashboard.paid_members import (
+    get_redis,
+    rebuild_paid_members,
+)
+
+
+class Command(BaseCommand):
+    help = 'Пересборка битовой карты оплативших за месяц в Redis из таблицы платежей'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', nargs='+', help='Месяцы ГГГГ-ММ, по умолчанию текущий')
+
+    def handle(self, *args, **options):
+        if get_redis() is None:
+            raise CommandError('Кэш не в Redis: битовые карты оплативших не используются')
+        try:
+            periods = [parse_period(period) for period in options['period'] or []] or [date.today().replace(day=1)]
+        except ValueError as error:
+            raise CommandError(error)
+
+        for period in periods:
+            paid_count = rebuild_paid_members(period.year, period.month)
+            if paid_count is None:
+                raise CommandError('%s: карту меняли во время каждой попытки пересборки' % period.strftime('%Y-%m'))
+            self.stdout.write(self.style.SUCCESS('%s: оплативших %s' % (period.strftime('%Y-%m'), paid_count)))
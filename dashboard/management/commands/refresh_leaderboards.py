@@ -0,0 +1,31 @@
+from datetime import date
+from django.core.management.base import (
+    BaseCommand,
+    CommandError,
+)
+from dashboard.export import parse_period
+from dashboard.tasks import update_leaderboards
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчет рейтингов за месяц одним проходом по лесу. По расписанию рейтинги пересчитываются '
+        'только при закрытии месяца'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', nargs='+', help='Месяцы ГГГГ-ММ, по умолчанию текущий')
+        parser.add_argument('--force', action='store_true', help='Пересчитать, даже если платежи и дерево не менялись')
+
+    def handle(self, *args, **options):
+        try:
+            periods = [parse_period(period) for period in options['period'] or []] or [date.today().replace(day=1)]
+        except ValueError as error:
+            raise CommandError(error)
+
+        for period in periods:
+            entries_count = update_leaderboards(period.year, period.month, options['force'])
+            if entries_count is None:
+                self.stdout.write('%s: без изменений' % period.strftime('%Y-%m'))
+            else:
+                self.stdout.write(self.style.SUCCESS('%s: мест в рейтингах %s' % (period.strftime('%Y-%m'), entries_count)))
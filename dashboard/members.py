@@ -0,0 +1,70 @@
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+from dashboard.models import Profile
+
+
+# Пользователь текущего запроса с профилем, родителем и реферальной ссылкой: ключ по id пользователя
+MEMBER_KEY = 'member:%s'
+
+# Короткое время жизни: кэш сбрасывается при сохранении пользователя и профиля, но массовые
+# изменения (перенос накоплений, пересчет дерева) попадают в него не позже чем через минуту
+MEMBER_TIMEOUT = 60
+
+
+def load_member(user_id):
+    # Один запрос: профиль, пользователь, родитель с его пользователем и реферальная ссылка
+    profile = Profile.objects.select_related('user', 'parent__user', 'referral').get(user_id=user_id)
+    # user.profile без запроса
+    setattr(profile.user, User.profile.cache_name, profile)
+    return profile
+
+
+def get_member(user_id):
+    profile = cache.get(MEMBER_KEY % user_id)
+    if profile is None:
+        try:
+            profile = load_member(user_id)
+        except Profile.DoesNotExist:
+            return None
+        cache.set(MEMBER_KEY % user_id, profile, MEMBER_TIMEOUT)
+    return profile
+
+
+def invalidate_member(user_id):
+    # После фиксации транзакции, иначе кэш успеют заполнить старыми данными
+    transaction.on_commit(lambda: cache.delete(MEMBER_KEY % user_id))
+
+
+class MemberBackend(ModelBackend):
+    # Пользователь сессии берется из кэша вместе с профилем; без профиля - обычная загрузка
+
+    def get_user(self, user_id):
+        profile = get_member(user_id)
+        if profile is None:
+            return super(MemberBackend, self).get_user(user_id)
+        return profile.user if self.user_can_authenticate(profile.user) else None
+
+
+def get_request_profile(request):
+    if not request.user.is_authenticated:
+        return None
+    # Загружен вместе с пользователем через MemberBackend
+    profile = getattr(request.user, User.profile.cache_name, None)
+    if profile is None:
+        profile = get_member(request.user.id)
+    return profile
+
+
+class MemberMiddleware(object):
+    # После AuthenticationMiddleware: request.profile - профиль текущего пользователя
+    # (None у анонимного), загружается при первом обращении
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.profile = SimpleLazyObject(lambda: get_request_profile(request))
+        return self.get_response(request)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 15:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyBonus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(verbose_name='Месяц')),
+                ('first_level_bonus_referral_count', models.PositiveIntegerField(default=0, verbose_name='Активных последователей первого уровня')),
+                ('second_level_bonus_referral_count', models.PositiveIntegerField(default=0, verbose_name='Активных последователей второго уровня')),
+                ('third_level_bonus_referral_count', models.PositiveIntegerField(default=0, verbose_name='Активных последователей третьего уровня')),
+                ('fourth_level_bonus_referral_count', models.PositiveIntegerField(default=0, verbose_name='Активных последователей четвертого уровня')),
+                ('first_level_amount', models.FloatField(default=0, verbose_name='Бонусы с первого уровня')),
+                ('second_level_amount', models.FloatField(default=0, verbose_name='Бонусы со второго уровня')),
+                ('third_level_amount', models.FloatField(default=0, verbose_name='Бонусы с третьего уровня')),
+                ('fourth_level_amount', models.FloatField(default=0, verbose_name='Бонусы с четвертого уровня')),
+                ('amount_from_parent', models.FloatField(default=0, verbose_name='Процент от родителя')),
+                ('month_amount', models.FloatField(default=0, verbose_name='Бонусы за месяц')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_bonuses', to='dashboard.Profile', verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Бонусы за месяц',
+                'verbose_name_plural': 'Бонусы по месяцам',
+                'db_table': 'monthly_bonus',
+                'ordering': ['-period'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlybonus',
+            unique_together=set([('profile', 'period')]),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 15:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_referral_paths(apps, schema_editor):
+    Profile = apps.get_model('dashboard', 'Profile')
+    ReferralPath = apps.get_model('dashboard', 'ReferralPath')
+    parents = dict(Profile.objects.values_list('id', 'parent_id'))
+    paths = []
+    for descendant_id in parents:
+        # Поднимаемся по цепочке родителей не более чем на четыре уровня
+        ancestor_id = parents[descendant_id]
+        depth = 1
+        while ancestor_id and depth <= 4:
+            paths.append(ReferralPath(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth))
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    ReferralPath.objects.bulk_create(paths, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0002_monthly_bonus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralPath',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveSmallIntegerField(verbose_name='Уровень')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_paths', to='dashboard.Profile', verbose_name='Предок')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_paths', to='dashboard.Profile', verbose_name='Последователь')),
+            ],
+            options={
+                'verbose_name': 'Связь с последователем',
+                'verbose_name_plural': 'Связи с последователями',
+                'db_table': 'referral_path',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='referralpath',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='referralpath',
+            index_together=set([('descendant', 'depth'), ('ancestor', 'depth')]),
+        ),
+        migrations.RunPython(
+            fill_referral_paths,
+            migrations.RunPython.noop,
+        ),
+    ]
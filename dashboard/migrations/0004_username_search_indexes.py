@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        ('dashboard', '0003_referral_path'),
+    ]
+
+    operations = [
+        # Поиск по префиксу: username__istartswith -> UPPER("username"::text) LIKE 'ABC%'
+        migrations.RunSQL(
+            ['CREATE INDEX auth_user_username_upper_like ON auth_user (UPPER(username::text) text_pattern_ops);'],
+            ['DROP INDEX IF EXISTS auth_user_username_upper_like;'],
+        ),
+        # Поиск по подстроке: username__icontains -> UPPER("username"::text) LIKE '%ABC%'
+        migrations.RunSQL(
+            ['CREATE EXTENSION IF NOT EXISTS pg_trgm;'],
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            ['CREATE INDEX auth_user_username_upper_trgm ON auth_user USING gin (UPPER(username::text) gin_trgm_ops);'],
+            ['DROP INDEX IF EXISTS auth_user_username_upper_trgm;'],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 15:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_username_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', 'paid', 'date'], name='payment_user_paid_date_idx'),
+        ),
+        # Все оплатившие за месяц: частичный индекс только по оплаченным платежам
+        migrations.RunSQL(
+            ['CREATE INDEX payment_paid_date_user_idx ON payment (date, user_id) WHERE paid;'],
+            ['DROP INDEX IF EXISTS payment_paid_date_user_idx;'],
+        ),
+    ]
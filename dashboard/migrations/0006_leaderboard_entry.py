@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 16:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0005_payment_period_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(verbose_name='Месяц')),
+                ('board', models.CharField(choices=[('month_amount', 'Бонусы за месяц'), ('bonus_referral_count', 'Активные последователи'), ('first_level_bonus_referral_count', 'Активные последователи первого уровня'), ('second_level_bonus_referral_count', 'Активные последователи второго уровня'), ('third_level_bonus_referral_count', 'Активные последователи третьего уровня'), ('fourth_level_bonus_referral_count', 'Активные последователи четвертого уровня')], max_length=50, verbose_name='Рейтинг')),
+                ('value', models.FloatField(verbose_name='Значение')),
+                ('rank', models.PositiveIntegerField(verbose_name='Место')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_entries', to='dashboard.Profile', verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Место в рейтинге',
+                'verbose_name_plural': 'Рейтинги',
+                'db_table': 'leaderboard_entry',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='leaderboardentry',
+            unique_together=set([('period', 'board', 'profile')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='leaderboardentry',
+            index_together=set([('period', 'board', 'rank')]),
+        ),
+    ]
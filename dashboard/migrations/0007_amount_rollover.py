@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.5 on 2026-10-18 16:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0006_leaderboard_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AmountRollover',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(verbose_name='Месяц')),
+                ('amount', models.FloatField(verbose_name='Перенесено')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата переноса')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='amount_rollovers', to='dashboard.Profile', verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Перенос бонусов в накопления',
+                'verbose_name_plural': 'Переносы бонусов в накопления',
+                'db_table': 'amount_rollover',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='amountrollover',
+            unique_together=set([('period', 'profile')]),
+        ),
+    ]
@@ -1,4 +1,7 @@
-from django.db import models
+from django.db import (
+    models,
+    transaction,
+)
 from django.contrib.auth.models import User
 from datetime import date
 from mptt.models import (
@@ -8,11 +11,36 @@ from mptt.models import (
 from pinax.referrals.models import Referral
 from phonenumber_field.modelfields import PhoneNumberField
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import (
+    post_save,
+    post_delete,
+)
 from account.signals import user_signed_up
 from django.core.urlresolvers import reverse_lazy
 
 
+def month_range(year, month):
+    # Границы месяца [первое число, первое число следующего месяца): сравнение по индексу вместо EXTRACT
+    start = date(year, month, 1)
+    if month == 12:
+        end = date(year + 1, 1, 1)
+    else:
+        end = date(year, month + 1, 1)
+    return start, end
+
+
+class PaymentQuerySet(models.QuerySet):
+
+    def paid_in_period(self, year, month):
+        # Оплаченные платежи за месяц
+        start, end = month_range(year, month)
+        return self.filter(paid=True, date__gte=start, date__lt=end)
+
+    def paid_user_ids(self, year, month):
+        # Пользователи, оплатившие за месяц (только поля индекса user_id, paid, date)
+        return self.paid_in_period(year, month).order_by().values_list('user_id', flat=True).distinct()
+
+
 # "Payment" Model
 class Payment(models.Model):
     user = models.ForeignKey(
@@ -30,15 +58,33 @@ class Payment(models.Model):
         blank=False,
     )
 
+    objects = PaymentQuerySet.as_manager()
+
     class Meta:
         db_table = 'payment'
         verbose_name = 'Платеж'
         verbose_name_plural = 'Платежы'
         ordering = ["date"]
+        indexes = [
+            models.Index(fields=['user', 'paid', 'date'], name='payment_user_paid_date_idx'),
+        ]
 
     def __str__(self):
         return '%s (%s - %s)' % (self.user.username, self.date.strftime("%B"), self.date.strftime("%Y"))
 
+    def save(self, *args, **kwargs):
+        # Платеж и изменения счетчиков предков (сигнал post_save) фиксируются одной транзакцией:
+        # иначе запись "MonthlyBonus", созданная между ними по базе, уже учтет платеж, и изменение прибавится дважды
+        with transaction.atomic():
+            super(Payment, self).save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Payment, cls).from_db(db, field_names, values)
+        # Запоминаем значения из базы, чтобы при сохранении понять, изменился ли статус оплаты
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
 
 # "Profile" model
 class Profile(MPTTModel):
@@ -108,21 +154,300 @@ class Profile(MPTTModel):
     def __str__(self):
         return '%s (%s)' % (self.user.username, self.user.email)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Profile, cls).from_db(db, field_names, values)
+        # Запоминаем родителя из базы, чтобы при сохранении понять, сменился ли он
+        instance._loaded_parent_id = instance.parent_id
+        # И все загруженные поля, чтобы не сохранять неизмененный профиль
+        instance._loaded_values = instance.get_field_values()
+        return instance
+
+    def get_field_values(self):
+        # Значения загруженных полей (отложенные через defer/only не входят)
+        return {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
+        }
+
+    def get_dirty_fields(self):
+        # Поля, измененные после загрузки из базы или последнего сохранения.
+        # None - профиль еще не сохранен или загружен не из базы: изменения неизвестны
+        loaded_values = getattr(self, '_loaded_values', None)
+        if self.pk is None or loaded_values is None:
+            return None
+        return [
+            attname
+            for attname, value in self.get_field_values().items()
+            if attname not in loaded_values or loaded_values[attname] != value
+        ]
+
+
+# "ReferralPath" model
+class ReferralPath(models.Model):
+    ancestor = models.ForeignKey(
+        Profile,
+        on_delete=models.CASCADE,
+        related_name='descendant_paths',
+        verbose_name='Предок',
+    )
+    descendant = models.ForeignKey(
+        Profile,
+        on_delete=models.CASCADE,
+        related_name='ancestor_paths',
+        verbose_name='Последователь',
+    )
+    depth = models.PositiveSmallIntegerField(
+        verbose_name='Уровень',
+    )
+
+    class Meta:
+        db_table = 'referral_path'
+        verbose_name = 'Связь с последователем'
+        verbose_name_plural = 'Связи с последователями'
+        unique_together = ('ancestor', 'descendant')
+        index_together = (
+            ('ancestor', 'depth'),
+            ('descendant', 'depth'),
+        )
+
+    def __str__(self):
+        return '%s -> %s (%s)' % (self.ancestor_id, self.descendant_id, self.depth)
+
+
+# "MonthlyBonus" model
+class MonthlyBonus(models.Model):
+    profile = models.ForeignKey(
+        Profile,
+        on_delete=models.CASCADE,
+        related_name='monthly_bonuses',
+        verbose_name='Пользователь',
+    )
+    period = models.DateField(
+        verbose_name='Месяц',
+    )
+    first_level_bonus_referral_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Активных последователей первого уровня',
+    )
+    second_level_bonus_referral_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Активных последователей второго уровня',
+    )
+    third_level_bonus_referral_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Активных последователей третьего уровня',
+    )
+    fourth_level_bonus_referral_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Активных последователей четвертого уровня',
+    )
+    first_level_amount = models.FloatField(
+        default=0,
+        verbose_name='Бонусы с первого уровня',
+    )
+    second_level_amount = models.FloatField(
+        default=0,
+        verbose_name='Бонусы со второго уровня',
+    )
+    third_level_amount = models.FloatField(
+        default=0,
+        verbose_name='Бонусы с третьего уровня',
+    )
+    fourth_level_amount = models.FloatField(
+        default=0,
+        verbose_name='Бонусы с четвертого уровня',
+    )
+    amount_from_parent = models.FloatField(
+        default=0,
+        verbose_name='Процент от родителя',
+    )
+    month_amount = models.FloatField(
+        default=0,
+        verbose_name='Бонусы за месяц',
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Дата обновления',
+    )
+
+    class Meta:
+        db_table = 'monthly_bonus'
+        verbose_name = 'Бонусы за месяц'
+        verbose_name_plural = 'Бонусы по месяцам'
+        ordering = ['-period']
+        unique_together = ('profile', 'period')
+
+    def __str__(self):
+        return '%s (%s - %s)' % (self.profile.user.username, self.period.strftime("%B"), self.period.strftime("%Y"))
+
+
+# "LeaderboardEntry" model
+class LeaderboardEntry(models.Model):
+    BOARD_CHOICES = (
+        ('month_amount', 'Бонусы за месяц'),
+        ('bonus_referral_count', 'Активные последователи'),
+        ('first_level_bonus_referral_count', 'Активные последователи первого уровня'),
+        ('second_level_bonus_referral_count', 'Активные последователи второго уровня'),
+        ('third_level_bonus_referral_count', 'Активные последователи третьего уровня'),
+        ('fourth_level_bonus_referral_count', 'Активные последователи четвертого уровня'),
+    )
+
+    period = models.DateField(
+        verbose_name='Месяц',
+    )
+    board = models.CharField(
+        max_length=50,
+        choices=BOARD_CHOICES,
+        verbose_name='Рейтинг',
+    )
+    profile = models.ForeignKey(
+        Profile,
+        on_delete=models.CASCADE,
+        related_name='leaderboard_entries',
+        verbose_name='Пользователь',
+    )
+    value = models.FloatField(
+        verbose_name='Значение',
+    )
+    rank = models.PositiveIntegerField(
+        verbose_name='Место',
+    )
+
+    class Meta:
+        db_table = 'leaderboard_entry'
+        verbose_name = 'Место в рейтинге'
+        verbose_name_plural = 'Рейтинги'
+        unique_together = ('period', 'board', 'profile')
+        index_together = (
+            ('period', 'board', 'rank'),
+        )
+
+    def __str__(self):
+        return '%s: %s (%s)' % (self.board, self.profile_id, self.rank)
+
+
+# "AmountRollover" model
+class AmountRollover(models.Model):
+    # Бонусы за месяц, перенесенные в накопления профиля: по одной записи на профиль и месяц,
+    # чтобы повторный запуск переноса не начислил их второй раз
+    profile = models.ForeignKey(
+        Profile,
+        on_delete=models.CASCADE,
+        related_name='amount_rollovers',
+        verbose_name='Пользователь',
+    )
+    period = models.DateField(
+        verbose_name='Месяц',
+    )
+    amount = models.FloatField(
+        verbose_name='Перенесено',
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Дата переноса',
+    )
+
+    class Meta:
+        db_table = 'amount_rollover'
+        verbose_name = 'Перенос бонусов в накопления'
+        verbose_name_plural = 'Переносы бонусов в накопления'
+        unique_together = ('period', 'profile')
+
+    def __str__(self):
+        return '%s: %s (%s)' % (self.period, self.profile_id, self.amount)
+
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
-    if created:
+    if created and not getattr(instance, '_disable_profile_creation', False):
         Profile.objects.create(user=instance)
 
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
+    # Сохраняем профиль, только если его получили через этого пользователя и изменили.
+    # При входе (обновление last_login) профиль не читается из базы и не перезаписывается в дереве
+    if getattr(instance, '_disable_profile_creation', False):
+        return
+    profile = getattr(instance, User.profile.cache_name, None)
+    if profile is not None and profile.get_dirty_fields() != []:
+        profile.save()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_member_on_user_change(sender, instance, **kwargs):
+    from dashboard.members import invalidate_member
+    invalidate_member(instance.id)
+
+
+@receiver(post_delete, sender=Profile)
+def invalidate_member_on_profile_delete(sender, instance, **kwargs):
+    from dashboard.members import invalidate_member
+    invalidate_member(instance.user_id)
+
+
+@receiver(post_save, sender=Referral)
+@receiver(post_delete, sender=Referral)
+def invalidate_referral_code_on_change(sender, instance, **kwargs):
+    from dashboard.referral_clicks import invalidate_referral_code
+    invalidate_referral_code(instance.code)
 
 
 @receiver(user_signed_up)
 def handle_user_signed_up(sender, user, form, **kwargs):
     profile = user.profile
-    referral = Referral.create(user=user, redirect_to=reverse_lazy('account_signup'))
-    profile.referral = referral
-    profile.save()
+    if profile.referral_id is None:
+        referral = Referral.create(user=user, redirect_to=reverse_lazy('account_signup'))
+        profile.referral = referral
+        profile.save()
+
+
+@receiver(post_save, sender=Payment)
+def update_monthly_bonuses_on_payment_save(sender, instance, created, **kwargs):
+    from dashboard.bonus import update_payment_monthly_bonuses
+    loaded_values = getattr(instance, '_loaded_values', None)
+    if created or loaded_values is None:
+        old_payment = None
+    else:
+        old_payment = (loaded_values['user_id'], loaded_values['paid'], loaded_values['date'])
+    update_payment_monthly_bonuses(instance.id, old_payment, (instance.user_id, instance.paid, instance.date))
+    instance._loaded_values = {'user_id': instance.user_id, 'paid': instance.paid, 'date': instance.date}
+
+
+@receiver(post_delete, sender=Payment)
+def update_monthly_bonuses_on_payment_delete(sender, instance, **kwargs):
+    from dashboard.bonus import update_payment_monthly_bonuses
+    update_payment_monthly_bonuses(instance.id, (instance.user_id, instance.paid, instance.date), None)
+
+
+@receiver(post_save, sender=Profile)
+def handle_profile_parent_change(sender, instance, created, **kwargs):
+    from dashboard.tree import (
+        update_referral_paths,
+        get_ancestor_paths,
+    )
+    from dashboard.bonus import update_parent_monthly_bonuses
+    from dashboard.context_cache import invalidate_dashboard_information
+    from dashboard.members import invalidate_member
+    old_parent_id = getattr(instance, '_loaded_parent_id', None)
+    if old_parent_id != instance.parent_id:
+        # Предки до и после перемещения: у них меняется количество последователей
+        ancestor_ids = set()
+        if not created:
+            ancestor_ids.update(ancestor_id for ancestor_id, depth in get_ancestor_paths(instance))
+        # Сначала таблица связей, по ней ищутся предки при пересчете бонусов
+        update_referral_paths(instance, created)
+        ancestor_ids.update(ancestor_id for ancestor_id, depth in get_ancestor_paths(instance))
+        if not created:
+            update_parent_monthly_bonuses(instance, ancestor_ids)
+        # После фиксации транзакции, иначе кэш успеют заполнить старыми данными
+        invalidated_ids = [instance.id] + list(ancestor_ids)
+        transaction.on_commit(
+            lambda: invalidate_dashboard_information(invalidated_ids, date.today().year, date.today().month)
+        )
+    instance._loaded_parent_id = instance.parent_id
+    instance._loaded_values = instance.get_field_values()
+    invalidate_member(instance.user_id)
@@ -0,0 +1,152 @@
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+from dashboard.models import Payment
+
+
+# Битовая карта оплативших за месяц в Redis кэша: бит с номером id пользователя
+PAID_MEMBERS_KEY = 'paid_members:%s-%s'
+
+# Нулевой бит (id пользователей начинаются с 1) - отметка, что карта построена из таблицы платежей целиком.
+# Хранится в том же ключе: если Redis вытеснит карту, вместе с ней пропадет и отметка, и ответы возьмутся из базы
+PAID_MEMBERS_READY_BIT = 0
+
+# Счетчик изменений карты: пересборка повторяется, если карту меняли во время нее
+PAID_MEMBERS_CHANGES_KEY = 'paid_members_changes:%s-%s'
+
+# Карта строится во временном ключе и заменяет старую одной командой
+PAID_MEMBERS_BUILD_KEY = 'paid_members_build:%s-%s'
+
+# Пересборка карты месяца поставлена в очередь
+PAID_MEMBERS_REBUILD_KEY = 'paid_members_rebuild:%s-%s'
+PAID_MEMBERS_REBUILD_TIMEOUT = 60 * 60
+
+# Карты хранятся чуть больше года
+PAID_MEMBERS_TIMEOUT = 60 * 60 * 24 * 400
+
+# Количество пользователей в одной пачке команд Redis
+PAID_MEMBERS_BATCH_SIZE = 10000
+
+# Сколько раз пересобирать карту, если ее меняли во время пересборки
+PAID_MEMBERS_REBUILD_ATTEMPTS = 5
+
+
+def get_redis():
+    # Клиент Redis кэша; None, если кэш не в Redis (например, при разработке)
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def get_key(key, year, month):
+    # Ключи с префиксом и версией кэша, как у остальных ключей django-redis
+    return cache.make_key(key % (year, month))
+
+
+def get_paid_bits(user_ids, year, month):
+    # Биты пользователей одним обращением к Redis; None - карты нет или она не построена
+    redis = get_redis()
+    if redis is None:
+        return None
+    key = get_key(PAID_MEMBERS_KEY, year, month)
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.getbit(key, PAID_MEMBERS_READY_BIT)
+    for user_id in user_ids:
+        pipeline.getbit(key, user_id)
+    results = pipeline.execute()
+    if not results[0]:
+        schedule_paid_members_rebuild(year, month)
+        return None
+    return results[1:]
+
+
+def get_paid_status(user_id, year, month):
+    # Статус оплаты пользователя за месяц: из карты, без нее - из таблицы платежей
+    bits = get_paid_bits([user_id], year, month)
+    if bits is None:
+        return Payment.objects.filter(user_id=user_id).paid_in_period(year, month).exists()
+    return bool(bits[0])
+
+
+def get_paid_user_ids(user_ids, year, month):
+    # Оплатившие за месяц из списка пользователей
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    bits = get_paid_bits(user_ids, year, month)
+    if bits is None:
+        return set(Payment.objects.filter(user_id__in=user_ids).paid_user_ids(year, month))
+    return {user_id for user_id, bit in zip(user_ids, bits) if bit}
+
+
+def set_paid_statuses(statuses, year, month):
+    # statuses - словарь {id пользователя: оплатил ли}. Вызывается после фиксации изменений в базе
+    redis = get_redis()
+    if redis is None or not statuses:
+        return
+    key = get_key(PAID_MEMBERS_KEY, year, month)
+    pipeline = redis.pipeline(transaction=False)
+    for user_id, paid in statuses.items():
+        pipeline.setbit(key, user_id, 1 if paid else 0)
+    pipeline.expire(key, PAID_MEMBERS_TIMEOUT)
+    pipeline.incr(get_key(PAID_MEMBERS_CHANGES_KEY, year, month))
+    pipeline.expire(get_key(PAID_MEMBERS_CHANGES_KEY, year, month), PAID_MEMBERS_TIMEOUT)
+    pipeline.execute()
+
+
+def update_paid_statuses(user_ids, year, month, batch_size=PAID_MEMBERS_BATCH_SIZE):
+    # Платежи пользователей изменены массово: переносим их статусы из базы в карту после фиксации транзакции
+    if get_redis() is None:
+        return
+    user_ids = list(user_ids)
+
+    def update():
+        for start in range(0, len(user_ids), batch_size):
+            chunk = user_ids[start:start + batch_size]
+            paid_user_ids = set(Payment.objects.filter(user_id__in=chunk).paid_user_ids(year, month))
+            set_paid_statuses({user_id: user_id in paid_user_ids for user_id in chunk}, year, month)
+
+    transaction.on_commit(update)
+
+
+def rebuild_paid_members(year, month, batch_size=PAID_MEMBERS_BATCH_SIZE):
+    # Карта месяца из таблицы платежей. Строится во временном ключе и заменяет старую, только если
+    # за время чтения базы карту не меняли (WATCH на счетчике изменений), иначе строится заново
+    redis = get_redis()
+    if redis is None:
+        return None
+    key = get_key(PAID_MEMBERS_KEY, year, month)
+    build_key = get_key(PAID_MEMBERS_BUILD_KEY, year, month)
+    changes_key = get_key(PAID_MEMBERS_CHANGES_KEY, year, month)
+    for attempt in range(PAID_MEMBERS_REBUILD_ATTEMPTS):
+        with redis.pipeline() as watch:
+            watch.watch(changes_key)
+            redis.delete(build_key)
+            paid_count = 0
+            writer = redis.pipeline(transaction=False)
+            writer.setbit(build_key, PAID_MEMBERS_READY_BIT, 1)
+            for user_id in Payment.objects.paid_user_ids(year, month).iterator():
+                writer.setbit(build_key, user_id, 1)
+                paid_count += 1
+                if paid_count % batch_size == 0:
+                    writer.execute()
+            writer.execute()
+            try:
+                watch.multi()
+                watch.rename(build_key, key)
+                watch.expire(key, PAID_MEMBERS_TIMEOUT)
+                watch.execute()
+                return paid_count
+            except WatchError:
+                continue
+    redis.delete(build_key)
+    return None
+
+
+def schedule_paid_members_rebuild(year, month):
+    # Карта месяца еще не построена: строим в фоне, пока ответы берутся из базы
+    from dashboard.tasks import rebuild_paid_members_bitmap
+    if cache.add(PAID_MEMBERS_REBUILD_KEY % (year, month), True, PAID_MEMBERS_REBUILD_TIMEOUT):
+        transaction.on_commit(lambda: rebuild_paid_members_bitmap.delay(year, month))
@@ -0,0 +1,214 @@
+import csv
+import io
+from datetime import (
+    date,
+    datetime,
+)
+from django.contrib.auth.models import User
+from django.db import (
+    connection,
+    transaction,
+)
+from dashboard.bonus import refresh_payments_monthly_bonuses
+from dashboard.models import (
+    Payment,
+    month_range,
+)
+
+
+# Количество строк файла, для которых пользователи ищутся одним запросом
+PAYMENT_IMPORT_BATCH_SIZE = 5000
+
+# Сколько ошибочных строк показывать в отчете
+PAYMENT_IMPORT_MAX_ERRORS = 100
+
+PAID_VALUES = {
+    '1': True,
+    'true': True,
+    'yes': True,
+    'да': True,
+    '0': False,
+    'false': False,
+    'no': False,
+    'нет': False,
+}
+
+CREATE_STAGING_TABLE_SQL = '''
+    CREATE TEMPORARY TABLE payment_import (
+        user_id integer NOT NULL,
+        date date NOT NULL,
+        paid boolean NOT NULL
+    ) ON COMMIT DROP
+'''
+
+COPY_STAGING_TABLE_SQL = 'COPY payment_import (user_id, date, paid) FROM STDIN WITH (FORMAT csv)'
+
+# Несколько строк файла на одного пользователя и день: платеж оплачен, если оплачен хотя бы в одной
+UPDATE_PAYMENTS_SQL = '''
+    UPDATE payment SET paid = staged.paid
+    FROM (
+        SELECT user_id, date, bool_or(paid) AS paid FROM payment_import GROUP BY user_id, date
+    ) AS staged
+    WHERE payment.user_id = staged.user_id AND payment.date = staged.date AND payment.paid <> staged.paid
+'''
+
+INSERT_PAYMENTS_SQL = '''
+    INSERT INTO payment (user_id, date, paid)
+    SELECT staged.user_id, staged.date, bool_or(staged.paid) FROM payment_import AS staged
+    WHERE NOT EXISTS (
+        SELECT 1 FROM payment WHERE payment.user_id = staged.user_id AND payment.date = staged.date
+    )
+    GROUP BY staged.user_id, staged.date
+'''
+
+SELECT_PERIODS_SQL = '''
+    SELECT DISTINCT user_id, EXTRACT(YEAR FROM date)::integer, EXTRACT(MONTH FROM date)::integer FROM payment_import
+'''
+
+
+def parse_payment_row(row):
+    # Строка файла: логин или email, дата (ГГГГ-ММ-ДД), статус оплаты (необязательно, по умолчанию оплачен)
+    if len(row) < 2:
+        raise ValueError('ожидается: логин или email, дата[, оплачен]')
+    identifier = row[0].strip()
+    if not identifier:
+        raise ValueError('не указан пользователь')
+    try:
+        payment_date = datetime.strptime(row[1].strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('неверная дата "%s", ожидается ГГГГ-ММ-ДД' % row[1].strip())
+    if len(row) > 2 and row[2].strip():
+        try:
+            paid = PAID_VALUES[row[2].strip().lower()]
+        except KeyError:
+            raise ValueError('неизвестный статус оплаты "%s"' % row[2].strip())
+    else:
+        paid = True
+    return identifier, payment_date, paid
+
+
+def resolve_users(identifiers):
+    # id пользователей по логинам (уникальный индекс), затем по email - только для ненайденных.
+    # Email, указанный у нескольких пользователей, не используется
+    user_ids = dict(User.objects.filter(username__in=identifiers).values_list('username', 'id'))
+    emails = [identifier for identifier in identifiers if identifier not in user_ids and '@' in identifier]
+    if emails:
+        email_user_ids = {}
+        for user_id, email in User.objects.filter(email__in=emails).values_list('id', 'email'):
+            email_user_ids[email] = None if email in email_user_ids else user_id
+        for email, user_id in email_user_ids.items():
+            if user_id is not None:
+                user_ids[email] = user_id
+    return user_ids
+
+
+def copy_payment_batch(cursor, batch, result):
+    user_ids = resolve_users({identifier for line_number, identifier, payment_date, paid in batch})
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for line_number, identifier, payment_date, paid in batch:
+        user_id = user_ids.get(identifier)
+        if user_id is None:
+            add_import_error(result, line_number, 'пользователь "%s" не найден' % identifier)
+            continue
+        writer.writerow((user_id, payment_date.isoformat(), 't' if paid else 'f'))
+        result['imported'] += 1
+    buffer.seek(0)
+    cursor.copy_expert(COPY_STAGING_TABLE_SQL, buffer)
+
+
+def add_import_error(result, line_number, message):
+    result['errors_count'] += 1
+    if len(result['errors']) < PAYMENT_IMPORT_MAX_ERRORS:
+        result['errors'].append((line_number, message))
+
+
+def import_payments(lines, batch_size=PAYMENT_IMPORT_BATCH_SIZE):
+    # Загрузка платежей из CSV: строки через COPY во временную таблицу, затем одним UPDATE и одним INSERT в "payment".
+    # Сигналы "Payment" при этом не срабатывают, бонусы пересчитываются один раз в конце
+    result = {
+        'rows': 0,
+        'imported': 0,
+        'created': 0,
+        'updated': 0,
+        'errors_count': 0,
+        'errors': [],
+    }
+    periods = {}
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING_TABLE_SQL)
+            batch = []
+            for line_number, row in enumerate(csv.reader(lines), 1):
+                if not row or (line_number == 1 and len(row) > 1 and row[1].strip().lower() == 'date'):
+                    # Пустые строки и заголовок
+                    continue
+                result['rows'] += 1
+                try:
+                    batch.append((line_number,) + parse_payment_row(row))
+                except ValueError as error:
+                    add_import_error(result, line_number, str(error))
+                    continue
+                if len(batch) >= batch_size:
+                    copy_payment_batch(cursor, batch, result)
+                    batch = []
+            if batch:
+                copy_payment_batch(cursor, batch, result)
+
+            cursor.execute('ANALYZE payment_import')
+            cursor.execute(UPDATE_PAYMENTS_SQL)
+            result['updated'] = cursor.rowcount
+            cursor.execute(INSERT_PAYMENTS_SQL)
+            result['created'] = cursor.rowcount
+
+            cursor.execute(SELECT_PERIODS_SQL)
+            for user_id, year, month in cursor.fetchall():
+                periods.setdefault((year, month), []).append(user_id)
+
+        # Один пересчет бонусов на каждый затронутый месяц
+        for (year, month), user_ids in periods.items():
+            refresh_payments_monthly_bonuses(user_ids, year, month)
+    return result
+
+
+def mark_paid_for_month(user_ids, year, month, batch_size=PAYMENT_IMPORT_BATCH_SIZE):
+    # Отметка оплаты за месяц для пачки пользователей (действия в админке): неоплаченные платежи месяца -
+    # одним UPDATE, пользователям без платежа - bulk_create; бонусы пересчитываются один раз в конце
+    start, end = month_range(year, month)
+    if start <= date.today() < end:
+        payment_date = date.today()
+    else:
+        payment_date = start
+    user_ids = list(set(user_ids))
+    marked_user_ids = []
+    with transaction.atomic():
+        for offset in range(0, len(user_ids), batch_size):
+            chunk = user_ids[offset:offset + batch_size]
+            paid_user_ids = set(Payment.objects.filter(user_id__in=chunk).paid_user_ids(year, month))
+            pending_user_ids = [user_id for user_id in chunk if user_id not in paid_user_ids]
+            if not pending_user_ids:
+                continue
+            month_payments = Payment.objects.filter(user_id__in=pending_user_ids, date__gte=start, date__lt=end)
+            month_payments.filter(paid=False).update(paid=True)
+            existing_user_ids = set(month_payments.order_by().values_list('user_id', flat=True).distinct())
+            Payment.objects.bulk_create([
+                Payment(user_id=user_id, date=payment_date, paid=True)
+                for user_id in pending_user_ids
+                if user_id not in existing_user_ids
+            ])
+            marked_user_ids.extend(pending_user_ids)
+        refresh_payments_monthly_bonuses(marked_user_ids, year, month)
+    return len(marked_user_ids)
+
+
+def mark_payments_paid(payments):
+    # Отметка выбранных платежей оплаченными одним UPDATE и пересчет бонусов по затронутым месяцам
+    periods = {}
+    with transaction.atomic():
+        payments = payments.filter(paid=False)
+        for user_id, payment_date in payments.order_by().values_list('user_id', 'date').distinct():
+            periods.setdefault((payment_date.year, payment_date.month), set()).add(user_id)
+        updated = payments.update(paid=True)
+        for (year, month), user_ids in periods.items():
+            refresh_payments_monthly_bonuses(user_ids, year, month)
+    return updated
@@ -0,0 +1,73 @@
+from itertools import chain
+import numpy
+from django.db.models.functions import Coalesce
+from dashboard.models import (
+    Payment,
+    Profile,
+)
+from dashboard.rules import rules
+
+
+def load_population(tree_ids=None):
+    # Весь лес (или деревья tree_ids) тремя массивами, упорядоченными по id: id профиля, id родителя (0 - корень)
+    # и id пользователя. Строки читаются курсором без кэша queryset и сразу укладываются в массив
+    profiles = Profile.objects.all()
+    if tree_ids is not None:
+        profiles = profiles.filter(tree_id__in=tree_ids)
+    rows = profiles.order_by('id').annotate(
+        parent_or_zero=Coalesce('parent_id', 0),
+    ).values_list('id', 'parent_or_zero', 'user_id').iterator()
+    values = numpy.fromiter(chain.from_iterable(rows), dtype=numpy.int64)
+    values = values.reshape(-1, 3)
+    return values[:, 0].copy(), values[:, 1].copy(), values[:, 2].copy()
+
+
+def get_parent_indexes(profile_ids, parent_ids):
+    # Позиция родителя в массиве профилей, -1 у корней
+    parent_indexes = numpy.searchsorted(profile_ids, parent_ids)
+    has_parent = parent_ids != 0
+    parent_indexes[~has_parent] = -1
+    return parent_indexes
+
+
+def get_population_bonuses(year, month, tree_ids=None):
+    # Бонусы за месяц сразу для всех участников (или только деревьев tree_ids): флаг оплаты каждого активного
+    # участника поднимается к предкам до четвертого уровня, по проходу numpy на уровень.
+    # Результат совпадает с записями "MonthlyBonus", но не читает и не пишет их
+    rules.check_price()
+    profile_ids, parent_ids, user_ids = load_population(tree_ids)
+    members = len(profile_ids)
+    parent_indexes = get_parent_indexes(profile_ids, parent_ids)
+    has_parent = parent_indexes >= 0
+
+    payments = Payment.objects.all()
+    if tree_ids is not None:
+        payments = payments.filter(user__profile__tree_id__in=tree_ids)
+    paid_user_ids = numpy.fromiter(payments.paid_user_ids(year, month).iterator(), dtype=numpy.int64)
+    paid = numpy.isin(user_ids, paid_user_ids)
+
+    # Предки активных участников: на каждом шаге поднимаемся на уровень выше
+    level_counts = numpy.zeros((rules.depth, members), dtype=numpy.int64)
+    ancestors = parent_indexes[paid]
+    for depth in range(rules.depth):
+        ancestors = ancestors[ancestors >= 0]
+        if not len(ancestors):
+            break
+        level_counts[depth] = numpy.bincount(ancestors, minlength=members)
+        ancestors = parent_indexes[ancestors]
+
+    level_amounts = level_counts * numpy.array([level.amount for level in rules.levels], dtype=numpy.float64)[:, None]
+    amounts_from_parent = has_parent * rules.parent_amount
+    # Складываем в том же порядке, что и при расчете одного пользователя
+    month_amounts = amounts_from_parent.copy()
+    for depth in range(rules.depth):
+        month_amounts += level_amounts[depth]
+    return {
+        'profile_ids': profile_ids,
+        'user_ids': user_ids,
+        'paid': paid,
+        'amounts_from_parent': amounts_from_parent,
+        'level_counts': level_counts,
+        'level_amounts': level_amounts,
+        'month_amounts': month_amounts,
+    }
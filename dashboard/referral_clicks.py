@@ -0,0 +1,223 @@
+import json
+import logging
+import time
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from pinax.referrals.conf import settings as referral_settings
+from pinax.referrals.models import (
+    Referral,
+    ReferralResponse,
+)
+from dashboard.paid_members import get_redis
+
+
+logger = logging.getLogger('dashboard.referral_clicks')
+
+# Реферальная ссылка по коду: (id, адрес перехода); False - ссылки с таким кодом нет
+REFERRAL_CODE_KEY = 'referral_code:%s'
+REFERRAL_CODE_TIMEOUT = 60 * 60 * 24
+REFERRAL_CODE_MISSING_TIMEOUT = 60
+
+# Очередь переходов по ссылкам в Redis кэша; записываются в базу пачками задачей flush_referral_clicks
+REFERRAL_CLICKS_KEY = 'referral_clicks'
+
+# Переходы сессии, еще не записанные в базу (множество значений из очереди): регистрация перед поиском
+# ссылки записывает их сама, основная очередь такие переходы пропускает
+REFERRAL_CLICK_SESSION_KEY = 'referral_click:%s'
+REFERRAL_CLICK_SESSION_TIMEOUT = 60 * 60 * 24
+
+# Переходы сессии, снятые flush_referral_clicks и еще не записанные им в базу: регистрация ждет их записи
+REFERRAL_CLICK_PROCESSING_KEY = 'referral_click_processing:%s'
+
+# Сколько регистрация ждет записи пачки с переходами своей сессии (секунды) и как часто проверяет
+REFERRAL_CLICK_PROCESSING_WAIT = 5
+REFERRAL_CLICK_PROCESSING_POLL = 0.05
+
+# Переходы, которые не удалось записать в базу: для разбора вручную
+REFERRAL_CLICKS_FAILED_KEY = 'referral_clicks_failed'
+
+# Количество переходов в одной вставке
+REFERRAL_CLICKS_BATCH_SIZE = 5000
+
+# Действие перехода по ссылке, как в pinax.referrals
+REFERRAL_CLICK_ACTION = 'RESPONDED'
+
+
+def get_referral_code(code):
+    referral = cache.get(REFERRAL_CODE_KEY % code)
+    if referral is None:
+        referral = Referral.objects.filter(code=code).values_list('id', 'redirect_to').first() or False
+        cache.set(
+            REFERRAL_CODE_KEY % code,
+            referral,
+            REFERRAL_CODE_TIMEOUT if referral else REFERRAL_CODE_MISSING_TIMEOUT,
+        )
+    return referral or None
+
+
+def invalidate_referral_code(code):
+    transaction.on_commit(lambda: cache.delete(REFERRAL_CODE_KEY % code))
+
+
+def get_click(request, referral_id, session_key):
+    # Поля ReferralResponse, как у Referral.respond
+    return {
+        'referral_id': referral_id,
+        'session_key': session_key,
+        'user_id': request.user.id if request.user.is_authenticated else None,
+        'ip_address': request.META.get(referral_settings.PINAX_REFERRALS_IP_ADDRESS_META_FIELD, ''),
+        'action': REFERRAL_CLICK_ACTION,
+        'created_at': timezone.now().isoformat(),
+    }
+
+
+def record_click(request, referral_id, session_key):
+    # Переход добавляется в очередь и в ожидающие записи переходы сессии одной транзакцией Redis;
+    # без Redis - сразу в базу
+    click = get_click(request, referral_id, session_key)
+    redis = get_redis()
+    if redis is None:
+        return create_responses([click])
+    value = json.dumps(click)
+    session_click_key = cache.make_key(REFERRAL_CLICK_SESSION_KEY % session_key)
+    pipeline = redis.pipeline()
+    pipeline.rpush(cache.make_key(REFERRAL_CLICKS_KEY), value)
+    pipeline.sadd(session_click_key, value)
+    pipeline.expire(session_click_key, REFERRAL_CLICK_SESSION_TIMEOUT)
+    pipeline.execute()
+
+
+def load_click(value):
+    return json.loads(value.decode() if isinstance(value, bytes) else value)
+
+
+def create_responses(clicks):
+    # Переходы по ссылкам, удаленным после перехода, пропускаются; пользователь, удаленный после перехода,
+    # не записывается
+    referral_ids = set(
+        Referral.objects.filter(id__in={click['referral_id'] for click in clicks}).values_list('id', flat=True)
+    )
+    user_ids = set(
+        User.objects.filter(
+            id__in={click['user_id'] for click in clicks if click['user_id'] is not None}
+        ).values_list('id', flat=True)
+    )
+    responses = [
+        ReferralResponse(
+            referral_id=click['referral_id'],
+            session_key=click['session_key'],
+            user_id=click['user_id'] if click['user_id'] in user_ids else None,
+            ip_address=click['ip_address'],
+            action=click['action'],
+            created_at=parse_datetime(click['created_at']),
+        )
+        for click in clicks
+        if click['referral_id'] in referral_ids
+    ]
+    ReferralResponse.objects.bulk_create(responses)
+    return len(responses)
+
+
+def claim_clicks(redis, values):
+    # Переход записывает тот, кто первым снял его из ожидающих переходов сессии:
+    # уже записанные flush_session_clicks пропускаются. Снятые переходы до записи в базу
+    # остаются в обрабатываемых переходах сессии, чтобы регистрация дождалась их
+    pipeline = redis.pipeline(transaction=False)
+    clicks = [load_click(value) for value in values]
+    for value, click in zip(values, clicks):
+        processing_key = cache.make_key(REFERRAL_CLICK_PROCESSING_KEY % click['session_key'])
+        pipeline.smove(cache.make_key(REFERRAL_CLICK_SESSION_KEY % click['session_key']), processing_key, value)
+        pipeline.expire(processing_key, REFERRAL_CLICK_SESSION_TIMEOUT)
+    moved = pipeline.execute()[::2]
+    return [
+        (value, click)
+        for value, click, removed in zip(values, clicks, moved)
+        if removed
+    ]
+
+
+def release_clicks(redis, claimed):
+    # Пачка записана (или отложена в очередь ошибок): переходы больше не обрабатываются
+    pipeline = redis.pipeline(transaction=False)
+    for value, click in claimed:
+        pipeline.srem(cache.make_key(REFERRAL_CLICK_PROCESSING_KEY % click['session_key']), value)
+    pipeline.execute()
+
+
+def save_clicks(redis, claimed):
+    # Пачка пишется одной вставкой; при ошибке - по одному переходу, не записанные переходы
+    # откладываются в очередь ошибок и в основную очередь не возвращаются
+    try:
+        with transaction.atomic():
+            return create_responses([click for _, click in claimed])
+    except Exception:
+        logger.exception('Пачка переходов (%s) не записана, запись по одному', len(claimed))
+    created = 0
+    failed = []
+    for value, click in claimed:
+        try:
+            with transaction.atomic():
+                created += create_responses([click])
+        except Exception:
+            logger.exception('Переход не записан: %s', value)
+            failed.append(value)
+    if failed:
+        redis.rpush(cache.make_key(REFERRAL_CLICKS_FAILED_KEY), *failed)
+    return created
+
+
+def flush_referral_clicks(batch_size=REFERRAL_CLICKS_BATCH_SIZE):
+    # Записывает очередь переходов в базу: пачка снимается с начала очереди одной транзакцией Redis
+    redis = get_redis()
+    if redis is None:
+        return 0
+    key = cache.make_key(REFERRAL_CLICKS_KEY)
+    created = 0
+    while True:
+        pipeline = redis.pipeline()
+        pipeline.lrange(key, 0, batch_size - 1)
+        pipeline.ltrim(key, batch_size, -1)
+        values, _ = pipeline.execute()
+        if not values:
+            return created
+        claimed = claim_clicks(redis, values)
+        if claimed:
+            try:
+                created += save_clicks(redis, claimed)
+            finally:
+                release_clicks(redis, claimed)
+        if len(values) < batch_size:
+            return created
+
+
+def take_session_clicks(redis, key):
+    # Все переходы из множества key, атомарно вместе с его удалением
+    pipeline = redis.pipeline()
+    pipeline.smembers(key)
+    pipeline.delete(key)
+    values, _ = pipeline.execute()
+    return [load_click(value) for value in values]
+
+
+def flush_session_clicks(request):
+    # Переходы этой сессии еще в очереди: записываем только их, чтобы Referral.record_response нашел
+    # переход в базе. Ожидающие переходы снимаются атомарно, и основная очередь их уже не запишет
+    redis = get_redis()
+    session_key = request.session.session_key
+    if redis is None or session_key is None:
+        return
+    clicks = take_session_clicks(redis, cache.make_key(REFERRAL_CLICK_SESSION_KEY % session_key))
+
+    # Переходы сессии уже снял flush_referral_clicks: ждем фиксации его пачки. Если он так и не записал
+    # их (остановлен или завис), записываем сами; при его позднем завершении переход будет записан дважды
+    processing_key = cache.make_key(REFERRAL_CLICK_PROCESSING_KEY % session_key)
+    deadline = time.time() + REFERRAL_CLICK_PROCESSING_WAIT
+    while redis.exists(processing_key) and time.time() < deadline:
+        time.sleep(REFERRAL_CLICK_PROCESSING_POLL)
+    clicks.extend(take_session_clicks(redis, processing_key))
+
+    if clicks:
+        create_responses(sorted(clicks, key=lambda click: click['created_at']))
@@ -0,0 +1,138 @@
+from bisect import bisect_left
+from collections import namedtuple
+import numpy
+from django.core.exceptions import ImproperlyConfigured
+from BonusDesk.settings import (
+    PRICE,
+    CLASSIC,
+    SILVER,
+    SILVER_BONUS,
+    GOLD,
+    GOLD_BONUS,
+    PLATINUM,
+    PLATINUM_BONUS,
+    BRILLIANT,
+    BRILLIANT_BONUS,
+)
+
+
+# Процент от стоимости абонемента, который получает пользователь с каждого уровня
+LEVEL_PERCENTS = (
+    (1, 'first', 10),
+    (2, 'second', 5),
+    (3, 'third', 2.5),
+    (4, 'fourth', 1),
+)
+
+# Процент от того, кто пригласил пользователя
+PARENT_PERCENT = 5
+
+# Уровень: номер, префикс полей, процент и сумма за одного активного последователя
+Level = namedtuple('Level', ('level', 'name', 'percent', 'amount'))
+
+# Пакет: название, сумма, которую нужно накопить, и бонус при ее достижении
+Tier = namedtuple('Tier', ('name', 'threshold', 'bonus'))
+
+# Положение накоплений: текущий пакет (None - накоплена сумма последнего) и сколько осталось накопить
+PackageStatus = namedtuple('PackageStatus', ('tier', 'remaining'))
+
+
+class BonusRules(object):
+    # Правила начисления и пакеты, разобранные из настроек один раз при запуске.
+    # Объект не изменяется после создания, поэтому общий для всех потоков и запросов
+
+    def __init__(self, price, level_percents, parent_percent, tiers):
+        self.price = int(price) if price is not None else None
+        self.levels = tuple(
+            Level(level, name, percent, self.price * percent / 100 if self.price is not None else None)
+            for level, name, percent in level_percents
+        )
+        self.depth = len(self.levels)
+        self.parent_amount = self.price * parent_percent / 100 if self.price is not None else None
+        self.tiers = tuple(tiers)
+        self.thresholds = [tier.threshold for tier in self.tiers]
+        self.threshold_array = numpy.array(self.thresholds)
+
+    def check_price(self):
+        if self.price is None:
+            raise ImproperlyConfigured('Не задана стоимость абонемента (переменная окружения PRICE)')
+
+    def get_level(self, depth):
+        return self.levels[depth - 1]
+
+    def get_monthly_values(self, level_counts, has_parent):
+        # Поля записи "MonthlyBonus" по количеству активных последователей каждого уровня
+        self.check_price()
+        amount_from_parent = self.parent_amount if has_parent else 0
+        values = {
+            'amount_from_parent': amount_from_parent,
+        }
+        month_amount = amount_from_parent
+        for level in self.levels:
+            level_bonus_referral_count = level_counts.get(level.level, 0)
+            level_amount = level_bonus_referral_count * level.amount
+            values[level.name + '_level_bonus_referral_count'] = level_bonus_referral_count
+            values[level.name + '_level_amount'] = level_amount
+            month_amount += level_amount
+        values['month_amount'] = month_amount
+        return values
+
+    def evaluate(self, amount):
+        # Пакет, до которого идут накопления: первый, сумма которого не меньше накоплений
+        index = bisect_left(self.thresholds, amount)
+        if index == len(self.tiers):
+            return PackageStatus(None, None)
+        tier = self.tiers[index]
+        return PackageStatus(tier, tier.threshold - amount)
+
+    def evaluate_many(self, amounts):
+        # То же для пачки накоплений (ежемесячные задачи, выгрузки): пакеты ищутся одним вызовом searchsorted
+        amounts = list(amounts)
+        indexes = numpy.searchsorted(self.threshold_array, amounts, side='left').tolist()
+        tiers = self.tiers
+        return [
+            PackageStatus(tiers[index], tiers[index].threshold - amount)
+            if index < len(tiers) else PackageStatus(None, None)
+            for index, amount in zip(indexes, amounts)
+        ]
+
+    def get_package_information(self, amount):
+        # Информация о том, сколько осталось накопить до преобретения пакета
+        status = self.evaluate(amount)
+        if status.tier is None:
+            last_tier = self.tiers[-1]
+            return {
+                'accumulate_status': 'Пакет "%s"' % last_tier.name,
+                'accumulate_text': 'Вы накопили нужную сумму. Мы дарим вам %s' % last_tier.bonus,
+                'accumulate': None,
+            }
+        tier = status.tier
+        if tier.bonus is None:
+            return {
+                'accumulate_status': 'Пакет "%s"' % tier.name,
+                'accumulate_text': 'Необходимо накопить: %s' % tier.threshold,
+                'accumulate': 'Осталось накопить: %s' % status.remaining,
+            }
+        return {
+            'accumulate_status': 'Пакет "%s"' % tier.name,
+            'accumulate_text': 'Необходимо накопить: %s. Бонус + %s' % (tier.threshold, tier.bonus),
+            'accumulate': status.remaining,
+        }
+
+
+def compile_rules():
+    return BonusRules(
+        price=PRICE,
+        level_percents=LEVEL_PERCENTS,
+        parent_percent=PARENT_PERCENT,
+        tiers=(
+            Tier('Classic', int(CLASSIC), None),
+            Tier('Silver', int(SILVER), int(SILVER_BONUS)),
+            Tier('Gold', int(GOLD), int(GOLD_BONUS)),
+            Tier('Platinum', int(PLATINUM), int(PLATINUM_BONUS)),
+            Tier('Brilliant', int(BRILLIANT), int(BRILLIANT_BONUS)),
+        ),
+    )
+
+
+rules = compile_rules()
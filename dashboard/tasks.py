@@ -0,0 +1,114 @@
+from datetime import (
+    date,
+    timedelta,
+)
+import numpy
+from celery import shared_task
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from dashboard.context_cache import pop_leaderboard_stale
+from dashboard.leaderboard import refresh_leaderboards
+from dashboard.models import (
+    Profile,
+    AmountRollover,
+)
+from dashboard.paid_members import rebuild_paid_members
+from dashboard.population import get_population_bonuses
+from dashboard.referral_clicks import flush_referral_clicks
+from dashboard.tree import (
+    TREE_REBUILD_KEY,
+    lock_tree,
+)
+
+
+# Количество профилей в одном UPDATE (одна транзакция на пачку)
+AMOUNT_COUNTING_CHUNK_SIZE = 5000
+
+
+def credit_month_amount(profile_ids, amount, period):
+    # Перенос одной пачки: профили блокируются, уже получившие бонусы за этот месяц пропускаются,
+    # а перенос записывается в той же транзакции. Повторный запуск (повторная доставка задачи,
+    # перезапуск после сбоя) начисляет только то, что еще не начислено
+    with transaction.atomic():
+        list(Profile.objects.filter(id__in=profile_ids).select_for_update().values_list('id', flat=True))
+        credited_ids = set(AmountRollover.objects.filter(
+            period=period,
+            profile_id__in=profile_ids,
+        ).values_list('profile_id', flat=True))
+        profile_ids = [profile_id for profile_id in profile_ids if profile_id not in credited_ids]
+        if not profile_ids:
+            return 0
+        AmountRollover.objects.bulk_create([
+            AmountRollover(profile_id=profile_id, period=period, amount=amount) for profile_id in profile_ids
+        ])
+        Profile.objects.filter(id__in=profile_ids).update(
+            amount=Coalesce(F('amount'), 0) + amount,
+        )
+    return len(profile_ids)
+
+
+@shared_task
+def amount_counting(year=None, month=None, chunk_size=AMOUNT_COUNTING_CHUNK_SIZE, tree_ids=None):
+    # По умолчанию считаем бонусы за предыдущий месяц
+    if year is None or month is None:
+        previous_month = date.today().replace(day=1) - timedelta(days=1)
+        year = previous_month.year
+        month = previous_month.month
+
+    # Бонусы всех участников (или только деревьев tree_ids) за месяц одним проходом по лесу
+    population = get_population_bonuses(year, month, tree_ids)
+    profile_ids = population['profile_ids']
+    month_amounts = population['month_amounts']
+
+    # Группируем профили по сумме начисления, чтобы обновить их несколькими UPDATE; одна транзакция на пачку
+    period = date(year, month, 1)
+    accrued = month_amounts != 0
+    amounts, amount_indexes, amount_counts = numpy.unique(
+        month_amounts[accrued], return_inverse=True, return_counts=True,
+    )
+    accrued_ids = profile_ids[accrued][numpy.argsort(amount_indexes, kind='stable')]
+    ends = numpy.cumsum(amount_counts)
+    for amount, amount_count, end in zip(amounts, amount_counts, ends):
+        ids = accrued_ids[end - amount_count:end].tolist()
+        for start in range(0, len(ids), chunk_size):
+            credit_month_amount(ids[start:start + chunk_size], float(amount), period)
+
+    # Окончательные рейтинги закрытого месяца из того же прохода (только по всему лесу)
+    if tree_ids is None:
+        refresh_leaderboards(year, month, population)
+    return len(profile_ids)
+
+
+@shared_task
+def update_leaderboards(year=None, month=None, force=False):
+    # Явный пересчет рейтингов (по расписанию пересчитываются только при закрытии месяца в amount_counting).
+    # По умолчанию - рейтинги текущего месяца, и только если платежи или дерево менялись
+    if year is None or month is None:
+        year = date.today().year
+        month = date.today().month
+    if not pop_leaderboard_stale(year, month) and not force:
+        return None
+    return refresh_leaderboards(year, month)
+
+
+@shared_task
+def rebuild_tree(tree_id):
+    # Снимаем отметку до перестроения: профили, добавленные во время него, запланируют новое
+    cache.delete(TREE_REBUILD_KEY % tree_id)
+    with transaction.atomic():
+        # Дерево может перестраивать и команда check_trees
+        lock_tree(tree_id)
+        Profile.objects.partial_rebuild(tree_id)
+
+
+@shared_task
+def rebuild_paid_members_bitmap(year, month):
+    return rebuild_paid_members(year, month)
+
+
+@shared_task
+def save_referral_clicks():
+    # Очередь переходов по реферальным ссылкам - в базу
+    return flush_referral_clicks()
@@ -1,5 +1,5 @@
 from django import template
-from dashboard.models import Payment
+from dashboard.paid_members import get_paid_status
 from datetime import date
 
 
@@ -8,13 +8,5 @@ register = template.Library()
 
 @register.filter(name='payment_status')
 def payment_status(value):
-    payment = Payment.objects.filter(
-        user=value,
-        date__month=date.today().month,
-        date__year=date.today().year,
-        paid=True
-    ).exists()
-    if payment:
-        return True
-    else:
-        return False
+    # Пользователь или его id
+    return get_paid_status(getattr(value, 'pk', value), date.today().year, date.today().month)
@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from dashboard.instrumentation import (
+    QueryBudgetExceeded,
+    check_query_budget,
+    get_queries_stats,
+)
+
+
+class QueryBudgetTestMixin(object):
+    # Для TestCase: ответ тестового клиента не должен превышать бюджет запросов своей страницы из QUERY_BUDGETS
+
+    def assertWithinQueryBudget(self, response, budget=None):
+        stats = getattr(response, 'instrumentation', None)
+        if stats is None:
+            self.fail('Нет данных о запросах: RequestInstrumentationMiddleware не подключен')
+        message = check_query_budget(response.resolver_match.view_name, stats['queries'], stats['duplicates'], budget)
+        if message:
+            self.fail(message)
+
+
+@contextmanager
+def query_budget(name, budget=None):
+    # Бюджет запросов для кода вне запросов (задачи, функции): по имени из QUERY_BUDGETS или явно
+    with CaptureQueriesContext(connection) as queries:
+        yield queries
+    stats = get_queries_stats(queries.captured_queries)
+    message = check_query_budget(name, stats['queries'], stats['duplicates'], budget)
+    if message:
+        raise QueryBudgetExceeded(message)
+
+
+def create_member(username, parent=None):
+    # Пользователь с профилем под родителем parent (профилем); связи и бонусы обновляются сигналами, как на сайте
+    user = User.objects.create_user(username, '%s@example.com' % username, 'password')
+    profile = user.profile
+    if parent is not None:
+        profile.parent = parent
+        profile.save()
+    return profile
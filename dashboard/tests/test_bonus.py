@@ -0,0 +1,95 @@
+from datetime import date
+from django.test import TestCase
+from dashboard.bonus import (
+    get_monthly_bonus,
+    refresh_monthly_bonuses,
+)
+from dashboard.models import (
+    MonthlyBonus,
+    Payment,
+    Profile,
+)
+from dashboard.rules import rules
+from dashboard.testing import create_member
+
+
+class MonthlyBonusLedgerTest(TestCase):
+    # Записи "MonthlyBonus", измененные по одной сигналами платежей и дерева, совпадают с полным пересчетом
+
+    def setUp(self):
+        self.today = date.today()
+        self.members = {'root': create_member('root')}
+        parent = self.members['root']
+        for username in ('a', 'b', 'c', 'd', 'e'):
+            self.members[username] = parent = create_member(username, parent)
+        self.members['x'] = create_member('x', self.members['root'])
+        self.members['y'] = create_member('y', self.members['x'])
+        # Часть записей уже есть (к ним прибавляются изменения), остальные создаются при первом изменении
+        for username in ('root', 'a', 'c', 'x'):
+            get_monthly_bonus(self.members[username], self.today.year, self.today.month)
+
+    def get_field_names(self):
+        names = ['amount_from_parent', 'month_amount']
+        for level in rules.levels:
+            names.extend((level.name + '_level_bonus_referral_count', level.name + '_level_amount'))
+        return names
+
+    def get_ledger(self):
+        return {
+            row['profile_id']: row
+            for row in MonthlyBonus.objects.filter(
+                period=date(self.today.year, self.today.month, 1),
+            ).values('profile_id', *self.get_field_names())
+        }
+
+    def assertLedgerConsistent(self):
+        ledger = self.get_ledger()
+        self.assertTrue(ledger)
+        profile_ids = list(Profile.objects.values_list('id', flat=True))
+        refresh_monthly_bonuses(profile_ids, self.today.year, self.today.month)
+        expected = self.get_ledger()
+        for profile_id, row in ledger.items():
+            for name in self.get_field_names():
+                self.assertAlmostEqual(row[name], expected[profile_id][name], msg='%s %s' % (profile_id, name))
+
+    def pay(self, username, paid=True):
+        return Payment.objects.create(user=self.members[username].user, paid=paid, date=self.today)
+
+    def test_paid_toggle(self):
+        payment = self.pay('e')
+        self.pay('c')
+        self.assertLedgerConsistent()
+        payment.paid = False
+        payment.save()
+        self.assertLedgerConsistent()
+        payment.paid = True
+        payment.save()
+        payment.delete()
+        self.assertLedgerConsistent()
+
+    def test_second_payment_in_month(self):
+        # Второй оплаченный платеж за месяц статус пользователя не меняет
+        first = self.pay('d')
+        self.pay('d')
+        first.delete()
+        self.assertLedgerConsistent()
+
+    def test_payment_reassigned(self):
+        payment = self.pay('e')
+        payment.user = self.members['y'].user
+        payment.save()
+        self.assertLedgerConsistent()
+
+    def test_parent_move(self):
+        self.pay('d')
+        self.pay('e')
+        self.pay('y')
+        # Ветка c с активными последователями переходит под y
+        profile = Profile.objects.get(id=self.members['c'].id)
+        profile.parent = Profile.objects.get(id=self.members['y'].id)
+        profile.save()
+        self.assertLedgerConsistent()
+        payment = self.pay('c')
+        payment.paid = False
+        payment.save()
+        self.assertLedgerConsistent()
@@ -0,0 +1,53 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+from pinax.referrals.models import Referral
+from dashboard.instrumentation import QueryBudgetExceeded
+from dashboard.models import Profile
+from dashboard.testing import (
+    QueryBudgetTestMixin,
+    query_budget,
+)
+
+
+class RequestInstrumentationTest(QueryBudgetTestMixin, TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('root', 'root@example.com', 'password')
+        Referral.create(user=self.user, redirect_to='/')
+        self.superuser = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def test_dashboard_within_query_budget(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinQueryBudget(response)
+
+    def test_query_budget_exceeded(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('dashboard'))
+        with self.assertRaises(AssertionError):
+            self.assertWithinQueryBudget(response, budget=0)
+
+    def test_server_timing_of_json_view(self):
+        # Шаблон JSON-ответа рендерится через render_to_string: его время и размер ответа тоже в заголовке
+        self.client.force_login(self.superuser)
+        response = self.client.post(reverse('search_user_information', args=['root']))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response.instrumentation['template_time'], 0)
+        self.assertIn('size;desc="%s bytes"' % len(response.content), response['Server-Timing'])
+        self.assertWithinQueryBudget(response)
+
+
+class QueryBudgetTest(TestCase):
+
+    def test_within_budget(self):
+        with query_budget('profiles', budget=1) as queries:
+            list(Profile.objects.all())
+        self.assertEqual(len(queries), 1)
+
+    def test_budget_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget('profiles', budget=1):
+                list(Profile.objects.all())
+                list(Profile.objects.all())
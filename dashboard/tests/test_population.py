@@ -0,0 +1,63 @@
+from datetime import date
+from django.test import TestCase
+from dashboard.bonus import refresh_monthly_bonuses
+from dashboard.models import (
+    Payment,
+    Profile,
+)
+from dashboard.population import get_population_bonuses
+from dashboard.rules import rules
+from dashboard.testing import create_member
+
+
+class PopulationBonusesTest(TestCase):
+    # Расчет всего леса массивами совпадает с записями "MonthlyBonus" по одному пользователю
+
+    def setUp(self):
+        self.today = date.today()
+        members = {}
+        for root in ('r1', 'r2'):
+            members[root] = parent = create_member(root)
+            for level in range(1, 6):
+                members['%s-%s' % (root, level)] = parent = create_member('%s-%s' % (root, level), parent)
+            members['%s-side' % root] = create_member('%s-side' % root, members['%s-1' % root])
+        members['single'] = create_member('single')
+        paid_usernames = ('r1-2', 'r1-4', 'r1-5', 'r1-side', 'r2-3', 'single')
+        for username, profile in members.items():
+            Payment.objects.create(user=profile.user, paid=username in paid_usernames, date=self.today)
+        # Оплата в другом месяце в расчет не входит
+        Payment.objects.create(user=members['r2-5'].user, paid=True, date=date(self.today.year - 1, 1, 1))
+        self.members = members
+
+    def assertMatchesMonthlyBonuses(self, population):
+        monthly_bonuses = refresh_monthly_bonuses(
+            population['profile_ids'].tolist(), self.today.year, self.today.month,
+        )
+        self.assertEqual(len(monthly_bonuses), len(population['profile_ids']))
+        for index, profile_id in enumerate(population['profile_ids'].tolist()):
+            monthly_bonus = monthly_bonuses[profile_id]
+            self.assertAlmostEqual(population['amounts_from_parent'][index], monthly_bonus.amount_from_parent)
+            self.assertAlmostEqual(population['month_amounts'][index], monthly_bonus.month_amount)
+            for depth, level in enumerate(rules.levels):
+                self.assertEqual(
+                    population['level_counts'][depth][index],
+                    getattr(monthly_bonus, level.name + '_level_bonus_referral_count'),
+                )
+                self.assertAlmostEqual(
+                    population['level_amounts'][depth][index],
+                    getattr(monthly_bonus, level.name + '_level_amount'),
+                )
+
+    def test_forest(self):
+        population = get_population_bonuses(self.today.year, self.today.month)
+        self.assertEqual(len(population['profile_ids']), Profile.objects.count())
+        self.assertMatchesMonthlyBonuses(population)
+
+    def test_trees(self):
+        tree_id = Profile.objects.get(id=self.members['r1'].id).tree_id
+        population = get_population_bonuses(self.today.year, self.today.month, [tree_id])
+        self.assertEqual(
+            sorted(population['profile_ids'].tolist()),
+            sorted(Profile.objects.filter(tree_id=tree_id).values_list('id', flat=True)),
+        )
+        self.assertMatchesMonthlyBonuses(population)
@@ -0,0 +1,61 @@
+from django.test import TestCase
+from dashboard.models import (
+    Profile,
+    ReferralPath,
+)
+from dashboard.testing import create_member
+from dashboard.tree import REFERRAL_PATH_DEPTH
+
+
+class ReferralPathTest(TestCase):
+
+    def setUp(self):
+        # Цепочка глубже четвертого уровня и боковая ветка у корня
+        self.members = {'root': create_member('root')}
+        parent = self.members['root']
+        for username in ('a', 'b', 'c', 'd', 'e', 'f'):
+            self.members[username] = parent = create_member(username, parent)
+        self.members['x'] = create_member('x', self.members['root'])
+        self.members['y'] = create_member('y', self.members['x'])
+
+    def get_expected_paths(self):
+        # Связи до четвертого уровня по родителям профилей
+        parent_ids = dict(Profile.objects.values_list('id', 'parent_id'))
+        paths = set()
+        for descendant_id in parent_ids:
+            ancestor_id = parent_ids[descendant_id]
+            depth = 1
+            while ancestor_id is not None and depth <= REFERRAL_PATH_DEPTH:
+                paths.add((ancestor_id, descendant_id, depth))
+                ancestor_id = parent_ids[ancestor_id]
+                depth += 1
+        return paths
+
+    def assertPathsConsistent(self):
+        self.assertEqual(
+            set(ReferralPath.objects.values_list('ancestor_id', 'descendant_id', 'depth')),
+            self.get_expected_paths(),
+        )
+
+    def move(self, username, parent_username):
+        profile = Profile.objects.get(id=self.members[username].id)
+        profile.parent = Profile.objects.get(id=self.members[parent_username].id) if parent_username else None
+        profile.save()
+
+    def test_created(self):
+        self.assertPathsConsistent()
+
+    def test_subtree_move(self):
+        # Ветка b (с последователями до пятого уровня) переходит под y: меняются и дальние связи
+        self.move('b', 'y')
+        self.assertPathsConsistent()
+
+    def test_subtree_move_to_root(self):
+        self.move('c', None)
+        self.assertPathsConsistent()
+
+    def test_subtree_moves_back(self):
+        self.move('b', 'y')
+        self.move('b', 'a')
+        self.move('x', 'e')
+        self.assertPathsConsistent()
@@ -0,0 +1,195 @@
+from collections import Counter
+from django.core.cache import cache
+from django.db import (
+    connection,
+    transaction,
+)
+from django.db.models import Count
+from dashboard.models import (
+    Profile,
+    ReferralPath,
+)
+from dashboard.paid_members import get_paid_user_ids
+
+
+# Глубина, на которую хранятся связи предок - последователь
+REFERRAL_PATH_DEPTH = 4
+
+# Ключ кэша, отмечающий, что перестроение дерева уже запланировано
+TREE_REBUILD_KEY = 'tree_rebuild:%s'
+TREE_REBUILD_TIMEOUT = 60 * 10
+
+# Первый ключ advisory lock PostgreSQL для перестроения деревьев, второй - tree_id
+TREE_LOCK_CLASS = 1
+
+# Размер страницы прямых последователей в дереве на странице
+CHILDREN_PAGE_SIZE = 50
+CHILDREN_PAGE_MAX_SIZE = 200
+
+
+def update_referral_paths(profile, created=False):
+    # Поддерживаем таблицу связей (предок, последователь, уровень <= 4) при добавлении и перемещении пользователя
+    with transaction.atomic():
+        # Ветка пользователя: он сам (уровень 0) и последователи, у которых могут быть предки выше него
+        if created:
+            subtree = [(profile.id, 0)]
+        else:
+            subtree = [(profile.id, 0)] + list(
+                ReferralPath.objects.filter(
+                    ancestor=profile,
+                    depth__lt=REFERRAL_PATH_DEPTH,
+                ).values_list('descendant_id', 'depth')
+            )
+
+            # Удаляем связи ветки со старыми предками
+            old_ancestor_ids = list(ReferralPath.objects.filter(descendant=profile).values_list('ancestor_id', flat=True))
+            if old_ancestor_ids:
+                ReferralPath.objects.filter(
+                    ancestor_id__in=old_ancestor_ids,
+                    descendant_id__in=[descendant_id for descendant_id, depth in subtree],
+                ).delete()
+
+        if not profile.parent_id:
+            return
+
+        # Новые предки: родитель и его предки
+        ancestors = [(profile.parent_id, 1)] + [
+            (ancestor_id, depth + 1) for ancestor_id, depth in ReferralPath.objects.filter(
+                descendant_id=profile.parent_id,
+                depth__lt=REFERRAL_PATH_DEPTH,
+            ).values_list('ancestor_id', 'depth')
+        ]
+        ReferralPath.objects.bulk_create([
+            ReferralPath(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + descendant_depth)
+            for ancestor_id, ancestor_depth in ancestors
+            for descendant_id, descendant_depth in subtree
+            if ancestor_depth + descendant_depth <= REFERRAL_PATH_DEPTH
+        ])
+
+
+def get_ancestor_paths(profile):
+    # Предки до четвертого уровня: пары (id предка, уровень пользователя относительно предка)
+    return ReferralPath.objects.filter(descendant=profile).values_list('ancestor_id', 'depth')
+
+
+def queue_tree_rebuild(tree_id):
+    # Пока задача перестроения не началась, повторно ее не ставим
+    from dashboard.tasks import rebuild_tree
+    if cache.add(TREE_REBUILD_KEY % tree_id, True, TREE_REBUILD_TIMEOUT):
+        rebuild_tree.delay(tree_id)
+
+
+def schedule_tree_rebuild(tree_id):
+    # Перестроение дерева в фоне после фиксации транзакции. Отметку ставит тоже уже зафиксированная транзакция:
+    # после отката она не должна на TREE_REBUILD_TIMEOUT блокировать перестроение дерева
+    transaction.on_commit(lambda: queue_tree_rebuild(tree_id))
+
+
+def get_relative_depth(ancestor, profile):
+    # Уровень пользователя относительно предка: 0 - тот же пользователь, None - не в его ветке до четвертого уровня
+    if ancestor.id == profile.id:
+        return 0
+    return ReferralPath.objects.filter(
+        ancestor=ancestor,
+        descendant=profile,
+    ).values_list('depth', flat=True).first()
+
+
+def get_children_page(profile, year, month, after=None, limit=CHILDREN_PAGE_SIZE):
+    # Прямые последователи постранично по id (keyset): страница не зависит от размера ветки
+    children = Profile.objects.filter(parent=profile)
+    if after is not None:
+        children = children.filter(id__gt=after)
+    children = list(
+        children.order_by('id').annotate(
+            children_count=Count('children'),
+        ).values_list('id', 'user_id', 'user__username', 'children_count')[:limit + 1]
+    )
+    has_next = len(children) > limit
+    children = children[:limit]
+
+    # Оплатившие за месяц на этой странице: одно обращение к карте оплативших (без нее - один запрос)
+    paid_user_ids = get_paid_user_ids(
+        [user_id for child_id, user_id, username, children_count in children], year, month,
+    )
+
+    return [
+        {
+            'id': child_id,
+            'username': username,
+            'paid': user_id in paid_user_ids,
+            'children_count': children_count,
+        }
+        for child_id, user_id, username, children_count in children
+    ], children[-1][0] if has_next else None
+
+
+def check_tree(tree_id):
+    # Количество профилей дерева, у которых lft/rght/level не соответствуют связям с родителями; 0 - дерево цело.
+    # Одним запросом: профили по lft должны вкладываться друг в друга так же, как идут ветки по parent
+    nodes = list(
+        Profile.objects.filter(tree_id=tree_id).order_by('lft', 'id').values_list('id', 'parent_id', 'lft', 'rght', 'level')
+    )
+    # Границы всех профилей - ровно числа от 1 до 2n без повторов
+    bounds = Counter(bound for node in nodes for bound in node[2:4])
+    errors = set(
+        profile_id for profile_id, parent_id, lft, rght, level in nodes
+        if bounds[lft] > 1 or bounds[rght] > 1 or not 1 <= lft < rght <= 2 * len(nodes)
+    )
+    # Стек открытых ветвей: профиль должен лежать внутри своего родителя и на уровень глубже
+    stack = []
+    for index, (profile_id, parent_id, lft, rght, level) in enumerate(nodes):
+        while stack and stack[-1][1] < lft:
+            stack.pop()
+        if not stack and index:
+            # Второй корень или ветка вне корня
+            errors.add(profile_id)
+        elif parent_id != (stack[-1][0] if stack else None) or level != len(stack):
+            errors.add(profile_id)
+        elif stack and rght > stack[-1][1]:
+            errors.add(profile_id)
+        stack.append((profile_id, rght))
+    return len(errors)
+
+
+def lock_tree(tree_id, wait=True):
+    # Блокировка перестроения дерева до конца транзакции; False - дерево перестраивает другой процесс.
+    # Только на PostgreSQL, на остальных базах перестроения не выполняются параллельно
+    if connection.vendor != 'postgresql':
+        return True
+    with connection.cursor() as cursor:
+        if wait:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [TREE_LOCK_CLASS, tree_id])
+            return True
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s, %s)', [TREE_LOCK_CLASS, tree_id])
+        return cursor.fetchone()[0]
+
+
+def repair_tree(tree_id):
+    # Перестраивает дерево, если оно повреждено. Возвращает количество несоответствий после перестроения
+    # (None - дерево сейчас перестраивает другой процесс). Остальные деревья при этом не блокируются
+    with transaction.atomic():
+        if not lock_tree(tree_id, wait=False):
+            return None
+        # Строки дерева заблокированы до конца транзакции: вставки и перемещения в этом дереве ждут перестроения
+        list(Profile.objects.filter(tree_id=tree_id).select_for_update().values_list('id', flat=True))
+        if not check_tree(tree_id):
+            return 0
+
+        # Ветки, перенесенные к родителю из другого дерева без обновления tree_id, попадут в свое дерево
+        # только при перестроении дерева родителя
+        parent_tree_ids = sorted(set(
+            Profile.objects.filter(tree_id=tree_id).exclude(parent__tree_id=tree_id).exclude(
+                parent=None,
+            ).values_list('parent__tree_id', flat=True)
+        ))
+        for parent_tree_id in parent_tree_ids:
+            if not lock_tree(parent_tree_id, wait=False):
+                transaction.set_rollback(True)
+                return None
+            list(Profile.objects.filter(tree_id=parent_tree_id).select_for_update().values_list('id', flat=True))
+        for parent_tree_id in parent_tree_ids:
+            Profile.objects.partial_rebuild(parent_tree_id)
+
+        Profile.objects.partial_rebuild(tree_id)
+        return sum(check_tree(repaired_tree_id) for repaired_tree_id in [tree_id] + parent_tree_ids)
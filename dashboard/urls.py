@@ -3,9 +3,16 @@ from dashboard.views import (
     DashboardView,
     username_autocomplete,
     search_user_information,
+    user_information,
+    referral_children,
+    export_bonus_statements,
+    leaderboard,
     specify_parent,
 )
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import (
+    login_required,
+    user_passes_test,
+)
 from django.core.urlresolvers import reverse_lazy
 
 
@@ -31,6 +38,35 @@ urlpatterns = [
         name='search_user_information'
     ),
 
+    # Structured JSON information about user (exact username) with ETag support | Link available to superuser
+    url(
+        r'^user_information/(?P<username>[\w.@+\-]+)/$',
+        user_passes_test(lambda user: user.is_superuser, login_url=reverse_lazy('account_login'))(user_information),
+        name='user_information'
+    ),
+
+    # Direct children of a tree node, paginated by id | Link available to the node's ancestors and superuser
+    url(
+        r'^referral_children/(?P<profile_id>\d+)/$',
+        login_required(login_url=reverse_lazy('account_login'))(referral_children),
+        name='referral_children'
+    ),
+
+    # Streaming CSV/JSONL bonus statements for a month (?period=YYYY-MM&tree=&format=) | Link available to superuser
+    url(
+        r'^export_bonus_statements/$',
+        user_passes_test(lambda user: user.is_superuser, login_url=reverse_lazy('account_login'))(export_bonus_statements),
+        name='export_bonus_statements'
+    ),
+
+    # Precomputed monthly rankings: top places and rank of a user (?board=&period=YYYY-MM&limit=&username=)
+    # | Link available to superuser
+    url(
+        r'^leaderboard/$',
+        user_passes_test(lambda user: user.is_superuser, login_url=reverse_lazy('account_login'))(leaderboard),
+        name='leaderboard'
+    ),
+
     # Set parent if user has not registered in the system through the referral link
     url(
         r'^specify_parent/',
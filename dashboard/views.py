@@ -1,31 +1,61 @@
 import json
+import hashlib
 from datetime import date
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.http import (
+    Http404,
     HttpResponse,
+    HttpResponseBadRequest,
     JsonResponse,
+    StreamingHttpResponse,
+)
+from django.shortcuts import (
+    get_object_or_404,
+    redirect,
 )
 from django.template.loader import render_to_string
 from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views.generic import TemplateView
 from pinax.referrals.models import Referral
+from pinax.referrals.utils import ensure_session_key
 from dashboard.models import (
     Profile,
-    Payment,
+    LeaderboardEntry,
+)
+from dashboard.bonus import get_bonus_information
+from dashboard.rules import rules
+from dashboard.tree import (
+    REFERRAL_PATH_DEPTH,
+    CHILDREN_PAGE_SIZE,
+    CHILDREN_PAGE_MAX_SIZE,
+    schedule_tree_rebuild,
+    get_relative_depth,
+    get_children_page,
+)
+from dashboard.autocomplete import search_usernames
+from dashboard.export import (
+    EXPORT_FORMATS,
+    parse_period,
+    get_export_columns,
+    iter_bonus_statements,
+    iter_export_lines,
+)
+from dashboard.leaderboard import (
+    LEADERBOARD_SIZE,
+    LEADERBOARD_MAX_SIZE,
+    get_leaderboard_top,
+    get_leaderboard_rank,
 )
-from BonusDesk.settings import (
-    PRICE,
-    CLASSIC,
-    SILVER,
-    SILVER_BONUS,
-    GOLD,
-    GOLD_BONUS,
-    PLATINUM,
-    PLATINUM_BONUS,
-    BRILLIANT,
-    BRILLIANT_BONUS,
+from dashboard.referral_clicks import (
+    get_referral_code,
+    record_click,
+    flush_session_clicks,
 )
+from dashboard.context_cache import get_dashboard_version
+from BonusDesk.settings import SIGNUP_DELAY_MPTT_UPDATES
 from dashboard.forms import (
     SpecifyParentForm,
     SignupForm,
@@ -39,25 +69,42 @@ class SignupView(BaseSignupView):
     def generate_username(self, form):
         pass
 
+    def create_user(self, form, commit=True, model=None, **kwargs):
+        user = super(SignupView, self).create_user(form, commit=False, model=model, **kwargs)
+        # Профиль создается в after_signup одной записью в дерево, а не сигналом post_save
+        user._disable_profile_creation = True
+        if commit:
+            user.save()
+        return user
+
     def after_signup(self, form):
-        self.create_profile(form)
-        super(SignupView, self).after_signup(form)
+        # Реферальная ссылка, по которой пришел пользователь (переход мог еще не попасть в базу из очереди)
+        flush_session_clicks(self.request)
         action = Referral.record_response(self.request, "USER_SIGNUP")
-        if action is not None:
-            referral = Referral.objects.get(id=action.referral.id)
-            profile = Profile.objects.get(user=self.created_user)
-            profile.parent = Profile.objects.get(user=referral.user)
-            profile.save()
+        self.create_profile(form, action)
+        super(SignupView, self).after_signup(form)
 
-    def create_profile(self, form):
-        profile = self.created_user.profile
+    def create_profile(self, form, action=None):
+        profile = Profile(user=self.created_user)
         profile.first_name = form.cleaned_data["first_name"]
         profile.last_name = form.cleaned_data["last_name"]
         profile.middle_name = form.cleaned_data["middle_name"]
         profile.birth_date = form.cleaned_data["birth_date"]
         profile.address = form.cleaned_data["address"]
         profile.phone_number = form.cleaned_data["phone_number"]
-        profile.save()
+        profile.referral = Referral.create(user=self.created_user, redirect_to=reverse_lazy('account_signup'))
+        if action is not None:
+            profile.parent = Profile.objects.get(user_id=action.referral.user_id)
+
+        # Сохраняем профиль сразу с родителем: одна вставка в дерево вместо вставки корнем и перемещения
+        if SIGNUP_DELAY_MPTT_UPDATES and profile.parent is not None:
+            # Отложенный режим: поля lft/rght дерева пересчитываются в фоне
+            with Profile.objects.disable_mptt_updates():
+                profile.save()
+            schedule_tree_rebuild(profile.tree_id)
+        else:
+            profile.save()
+        return profile
 
 
 class DashboardView(TemplateView):
@@ -70,144 +117,30 @@ class DashboardView(TemplateView):
         context['user'] = self.request.user
 
         # Пользователь, который привел текущего пользователя в систему
-        profile = Profile.objects.get(user=self.request.user)
+        # (профиль загружен вместе с родителем и реферальной ссылкой, см. MemberMiddleware)
+        profile = self.request.profile
         if profile.parent:
             context['parent'] = profile.parent.user
-            parent_amount = (int(PRICE) * 5) / 100
         else:
             context['parent'] = None
-            parent_amount = 0
 
-        # Процент от того, кто пригласил тебя
-        context['amount_from_parent'] = parent_amount
-
-        # Рефералы (Последователи)
-        referrals = profile.get_descendants().filter(level__lte=profile.level + 4)
-        context['referrals'] = referrals
+        # Дерево последователей подгружается по частям через referral_children
+        context['profile_id'] = profile.id
 
         # Код реферальный конкретного пользователя.
         if not self.request.user.is_superuser:
-            context['referral_code'] = Referral.objects.get(user=self.request.user)
+            context['referral_code'] = profile.referral or Referral.objects.get(user=self.request.user)
 
         # Текущий год и месяц при обращении к страницы
         current_year = date.today().year
         current_month = date.today().month
 
-        # Счет пользователя за текущий месяц
-        current_month_amount = 0
-
-        # Количество пользователей от которых получает бонусы в каждом уровне
-        first_level_bonus_referral_count = 0
-        second_level_bonus_referral_count = 0
-        third_level_bonus_referral_count = 0
-        fourth_level_bonus_referral_count = 0
-
-        # Полученная сумма денег с каждого уровня.
-        first_level_amount = 0
-        second_level_amount = 0
-        third_level_amount = 0
-        fourth_level_amount = 0
-
-        # Количество последователей в каждом уровне
-        first_level_referral_count = 0
-        second_level_referral_count = 0
-        third_level_referral_count = 0
-        fourth_level_referral_count = 0
-
-        for referral in referrals:
-            if Payment.objects.filter(
-                    user=referral.user,
-                    date__month=current_month,
-                    date__year=current_year,
-                    paid=True
-            ).exists():
-                level = referral.level - profile.level
-                if level == 1:
-                    first_level_bonus_referral_count += 1
-                    first_level_referral_count += 1
-                    current_month_amount = current_month_amount + (int(PRICE) * 10 / 100)
-                    first_level_amount = first_level_amount + (int(PRICE) * 10 / 100)
-                elif level == 2:
-                    second_level_bonus_referral_count += 1
-                    second_level_referral_count += 1
-                    current_month_amount = current_month_amount + (int(PRICE) * 5 / 100)
-                    second_level_amount = second_level_amount + (int(PRICE) * 5 / 100)
-                elif level == 3:
-                    third_level_bonus_referral_count += 1
-                    third_level_referral_count += 1
-                    current_month_amount = current_month_amount + (int(PRICE) * 2.5 / 100)
-                    third_level_amount = third_level_amount + (int(PRICE) * 2.5 / 100)
-                elif level == 4:
-                    fourth_level_bonus_referral_count += 1
-                    fourth_level_referral_count += 1
-                    current_month_amount = current_month_amount + (int(PRICE) * 1 / 100)
-                    fourth_level_amount = fourth_level_amount + (int(PRICE) * 1 / 100)
-
-        context['current_month_amount'] = current_month_amount + parent_amount
-        context['first_level_bonus_referral_count'] = first_level_bonus_referral_count
-        context['second_level_bonus_referral_count'] = second_level_bonus_referral_count
-        context['third_level_bonus_referral_count'] = third_level_bonus_referral_count
-        context['fourth_level_bonus_referral_count'] = fourth_level_bonus_referral_count
-        context['bonus_referral_count'] = first_level_bonus_referral_count + second_level_bonus_referral_count + third_level_bonus_referral_count + fourth_level_bonus_referral_count
-        context['first_level_amount'] = first_level_amount
-        context['second_level_amount'] = second_level_amount
-        context['third_level_amount'] = third_level_amount
-        context['fourth_level_amount'] = fourth_level_amount
-        context['first_level_referral_count'] = first_level_referral_count
-        context['second_level_referral_count'] = second_level_referral_count
-        context['third_level_referral_count'] = third_level_referral_count
-        context['fourth_level_referral_count'] = fourth_level_referral_count
-
-        # Накопления за предыдущие месяцы
-        context['last_month_amount'] = profile.amount
-
-        # Общие накопления
-        if profile.amount is None:
-            amount = current_month_amount + parent_amount
-        else:
-            amount = current_month_amount + parent_amount + profile.amount
-        context['amount'] = amount
-
-        # Количество последователей
-        context['referrals_count'] = referrals.count()
-
-        # Статус отплаты текущего пользователя за текущий месяц
-        payment = Payment.objects.filter(
-            user=self.request.user,
-            date__month=current_month,
-            date__year=current_year,
-            paid=True
-        ).exists()
-        context['payment_status'] = payment
+        # Бонусы по уровням, накопления за текущий и предыдущие месяцы, статус отплаты текущего пользователя
+        context.update(get_bonus_information(profile, current_year, current_month))
+        amount = context['amount']
 
         # Информация о том, сколько осталось накопить до преобретения пакета
-        global accumulate_status, accumulate_text, accumulate
-        if amount <= int(CLASSIC):
-            accumulate_status = 'Пакет "Classic"'
-            accumulate_text = 'Необходимо накопить: ' + CLASSIC
-            accumulate = "Осталось накопить: " + str(int(CLASSIC) - amount)
-        elif int(CLASSIC) < amount <= int(SILVER):
-            accumulate_status = 'Пакет "Silver"'
-            accumulate_text = 'Необходимо накопить: ' + str(SILVER) + '. Бонус + ' + str(SILVER_BONUS)
-            accumulate = int(SILVER) - amount
-        elif int(SILVER) < amount <= int(GOLD):
-            accumulate_status = 'Пакет "Gold"'
-            accumulate_text = 'Необходимо накопить: ' + str(GOLD) + '. Бонус + ' + str(GOLD_BONUS)
-            accumulate = int(SILVER) - amount
-        elif int(SILVER) < amount <= int(PLATINUM):
-            accumulate_status = 'Пакет "Platinum"'
-            accumulate_text = 'Необходимо накопить: ' + str(PLATINUM) + '. Бонус + ' + str(PLATINUM_BONUS)
-            accumulate = int(PLATINUM) - amount
-        elif int(PLATINUM) < amount <= int(BRILLIANT):
-            accumulate_status = 'Пакет "Brilliant"'
-            accumulate_text = 'Необходимо накопить: ' + str(BRILLIANT) + '. Бонус + ' + str(BRILLIANT_BONUS)
-            accumulate = int(BRILLIANT) - amount
-        elif amount > int(BRILLIANT):
-            accumulate_status = 'Пакет "Brilliant"'
-            accumulate_text = 'Вы накопили нужную сумму. Мы дарим вам ' + str(BRILLIANT_BONUS)
-        context['accumulate_status'] = accumulate_status
-        context['accumulate_text'] = accumulate_text
-        context['accumulate'] = accumulate
+        context.update(rules.get_package_information(amount))
 
         return context
 
@@ -215,13 +148,12 @@ class DashboardView(TemplateView):
 def username_autocomplete(request):
     if request.is_ajax():
         username = request.GET.get('term', '')
-        users = User.objects.filter(username__icontains=username)
         results = []
-        for user in users:
+        for user_id, user_username in search_usernames(username):
             users_json = {
-                'id': user.id,
-                'label': user.username,
-                'value': user.username,
+                'id': user_id,
+                'label': user_username,
+                'value': user_username,
             }
             results.append(users_json)
         data = json.dumps(results)
@@ -232,14 +164,14 @@ def username_autocomplete(request):
 
 
 def search_user_information(request, username):
-    global accumulate_status, accumulate_text, accumulate, amount_from_parent, referral_code
-
-    # Находим пользователя по введеному username
-    user = User.objects.get(username__icontains=username)
+    # Находим пользователя по введеному username (точное совпадение, логин выбирается из подсказок)
+    user = get_object_or_404(User, username=username)
 
     # Его реферальный код
     if not user.is_superuser:
         referral_code = Referral.objects.get(user=user)
+    else:
+        referral_code = None
 
     # Инициализируем словарь
     data = dict()
@@ -248,140 +180,218 @@ def search_user_information(request, username):
     profile = Profile.objects.get(user=user)
     if profile.parent:
         parent = profile.parent.user
-        amount_from_parent = (int(PRICE) * 5) / 100
     else:
         parent = None
-        amount_from_parent = 0
-
-    # Рефералы (Последователи)
-    referrals = profile.get_descendants().filter(level__lte=profile.level + 4)
 
-    # Текущий год и месяц при обращении к страницы
-    current_year = date.today().year
-    current_month = date.today().month
-
-    # Счет пользователя за текущий месяц
-    current_month_amount = 0
-
-    # Количество пользователей от которых получает бонусы в каждом уровне
-    first_level_bonus_referral_count = 0
-    second_level_bonus_referral_count = 0
-    third_level_bonus_referral_count = 0
-    fourth_level_bonus_referral_count = 0
-
-    # Полученная сумма денег с каждого уровня.
-    first_level_amount = 0
-    second_level_amount = 0
-    third_level_amount = 0
-    fourth_level_amount = 0
-
-    # Количество последователей в каждом уровне
-    first_level_referral_count = 0
-    second_level_referral_count = 0
-    third_level_referral_count = 0
-    fourth_level_referral_count = 0
-
-    for referral in referrals:
-        if Payment.objects.filter(
-                user=referral.user,
-                date__month=current_month,
-                date__year=current_year,
-                paid=True
-        ).exists():
-            level = referral.level - profile.level
-            if level == 1:
-                first_level_bonus_referral_count += 1
-                first_level_referral_count += 1
-                current_month_amount = current_month_amount + (int(PRICE) * 10 / 100)
-                first_level_amount = first_level_amount + (int(PRICE) * 10 / 100)
-            elif level == 2:
-                second_level_bonus_referral_count += 1
-                second_level_referral_count += 1
-                current_month_amount = current_month_amount + (int(PRICE) * 5 / 100)
-                second_level_amount = second_level_amount + (int(PRICE) * 5 / 100)
-            elif level == 3:
-                third_level_bonus_referral_count += 1
-                third_level_referral_count += 1
-                current_month_amount = current_month_amount + (int(PRICE) * 2.5 / 100)
-                third_level_amount = third_level_amount + (int(PRICE) * 2.5 / 100)
-            elif level == 4:
-                fourth_level_bonus_referral_count += 1
-                fourth_level_referral_count += 1
-                current_month_amount = current_month_amount + (int(PRICE) * 1 / 100)
-                fourth_level_amount = fourth_level_amount + (int(PRICE) * 1 / 100)
-
-    bonus_referral_count = first_level_bonus_referral_count + second_level_bonus_referral_count + third_level_bonus_referral_count + fourth_level_bonus_referral_count
-
-    # Накопления за предыдущие месяцы
-    last_month_amount = profile.amount
-
-    # Общие накопления
-    if profile.amount is None:
-        amount = current_month_amount
-    else:
-        amount = current_month_amount + profile.amount + amount_from_parent
-
-    # Количество последователей
-    referrals_count = referrals.count()
+    # Бонусы по уровням, накопления за текущий и предыдущие месяцы
+    bonus_information = get_bonus_information(profile)
+    amount = bonus_information['amount']
 
     # Информация о том, сколько осталось накопить до преобретения пакета
-    if amount <= int(CLASSIC):
-        accumulate_status = 'Пакет "Classic"'
-        accumulate_text = 'Необходимо накопить: ' + str(CLASSIC)
-        accumulate = "Осталось накопить: " + str(int(CLASSIC) - amount)
-    elif int(CLASSIC) < amount <= int(SILVER):
-        accumulate_status = 'Пакет "Silver"'
-        accumulate_text = 'Необходимо накопить: ' + str(SILVER) + '. Бонус + ' + str(SILVER_BONUS)
-        accumulate = int(SILVER) - amount
-    elif int(SILVER) < amount <= int(GOLD):
-        accumulate_status = 'Пакет "Gold"'
-        accumulate_text = 'Необходимо накопить: ' + str(GOLD) + '. Бонус + ' + str(GOLD_BONUS)
-        accumulate = int(GOLD) - amount
-    elif int(GOLD) < amount <= int(PLATINUM):
-        accumulate_status = 'Пакет "Platinum"'
-        accumulate_text = 'Необходимо накопить: ' + str(PLATINUM) + '. Бонус + ' + str(PLATINUM_BONUS)
-        accumulate = int(PLATINUM) - amount
-    elif int(PLATINUM) < amount <= int(BRILLIANT):
-        accumulate_status = 'Пакет "Brilliant"'
-        accumulate_text = 'Необходимо накопить: ' + str(BRILLIANT) + '. Бонус + ' + str(BRILLIANT_BONUS)
-        accumulate = int(BRILLIANT) - amount
-    elif amount > int(BRILLIANT):
-        accumulate_status = 'Пакет "Brilliant"'
-        accumulate_text = 'Вы накопили нужную сумму. Мы дарим вам ' + str(BRILLIANT_BONUS)
+    package_information = rules.get_package_information(amount)
 
     # Формируем контекстные данные которые будум передовать в шаблон
     context = {
         'user': user,
         'request_user': request.user,
         'parent': parent,
-        'referrals': referrals,
-        'current_month_amount': current_month_amount,
-        'first_level_bonus_referral_count': first_level_bonus_referral_count,
-        'second_level_bonus_referral_count': second_level_bonus_referral_count,
-        'third_level_bonus_referral_count': third_level_bonus_referral_count,
-        'fourth_level_bonus_referral_count': fourth_level_bonus_referral_count,
-        'bonus_referral_count': bonus_referral_count,
-        'first_level_amount': first_level_amount,
-        'second_level_amount': second_level_amount,
-        'third_level_amount': third_level_amount,
-        'fourth_level_amount': fourth_level_amount,
-        'first_level_referral_count': first_level_referral_count,
-        'second_level_referral_count': second_level_referral_count,
-        'third_level_referral_count': third_level_referral_count,
-        'fourth_level_referral_count': fourth_level_referral_count,
-        'last_month_amount': last_month_amount,
-        'amount': amount,
-        'referrals_count': referrals_count,
-        'accumulate_status': accumulate_status,
-        'accumulate_text': accumulate_text,
-        'accumulate': accumulate,
-        'amount_from_parent': amount_from_parent,
+        'profile_id': profile.id,
         'referral_code': referral_code,
     }
+    context.update(bonus_information)
+    context.update(package_information)
     data['dashboard_block_about_user'] = render_to_string('dashboard_block.html', context)
     return JsonResponse(data)
 
 
+def user_information(request, username):
+    # Точный поиск по логину (уникальный индекс), а не по подстроке
+    user = get_object_or_404(User, username=username)
+    profile = get_object_or_404(Profile.objects.select_related('parent__user', 'referral'), user=user)
+
+    # Текущий год и месяц при обращении к страницы
+    current_year = date.today().year
+    current_month = date.today().month
+
+    # ETag по версии бонусов пользователя и по возвращаемым полям пользователя и профиля (они уже загружены):
+    # если данные не менялись, возвращаем 304 без пересчета
+    etag = quote_etag(hashlib.md5(json.dumps([
+        profile.id,
+        get_dashboard_version(profile.id),
+        current_year,
+        current_month,
+        profile.amount,
+        profile.parent.user.username if profile.parent else None,
+        profile.referral.code if profile.referral else None,
+        user.username,
+        user.email,
+        user.is_superuser,
+        profile.first_name,
+        profile.last_name,
+        profile.middle_name,
+        str(profile.phone_number),
+    ]).encode('utf-8')).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        return response
+
+    # Бонусы по уровням, накопления за текущий и предыдущие месяцы
+    bonus_information = get_bonus_information(profile, current_year, current_month)
+    package_information = rules.get_package_information(bonus_information['amount'])
+
+    if profile.parent:
+        parent = {
+            'id': profile.parent.user.id,
+            'username': profile.parent.user.username,
+        }
+    else:
+        parent = None
+
+    data = {
+        'user': {
+            'id': user.id,
+            'username': user.username,
+            'email': user.email,
+            'first_name': profile.first_name,
+            'last_name': profile.last_name,
+            'middle_name': profile.middle_name,
+            'phone_number': str(profile.phone_number),
+            'is_superuser': user.is_superuser,
+        },
+        'referral_code': profile.referral.code if profile.referral else None,
+        'parent': parent,
+        'period': '%04d-%02d' % (current_year, current_month),
+        'payment_status': bonus_information['payment_status'],
+        'bonus': {
+            'levels': [
+                {
+                    'level': level,
+                    'referral_count': bonus_information[name + '_level_referral_count'],
+                    'bonus_referral_count': bonus_information[name + '_level_bonus_referral_count'],
+                    'amount': bonus_information[name + '_level_amount'],
+                }
+                for level, name, percent, amount in rules.levels
+            ],
+            'amount_from_parent': bonus_information['amount_from_parent'],
+            'current_month_amount': bonus_information['current_month_amount'],
+            'last_month_amount': bonus_information['last_month_amount'],
+            'amount': bonus_information['amount'],
+        },
+        'package': package_information,
+        'tree': {
+            'referrals_count': bonus_information['referrals_count'],
+            'bonus_referral_count': bonus_information['bonus_referral_count'],
+            'children_count': bonus_information['first_level_referral_count'],
+        },
+    }
+    response = JsonResponse(data)
+    response['ETag'] = etag
+    return response
+
+
+def referral_children(request, profile_id):
+    profile = get_object_or_404(Profile, id=profile_id)
+
+    # Пользователь видит ветку только до четвертого уровня, суперпользователь - любую
+    if request.user.is_superuser:
+        depth = None
+    else:
+        depth = get_relative_depth(request.profile, profile)
+        if depth is None or depth >= REFERRAL_PATH_DEPTH:
+            raise Http404
+
+    try:
+        after = int(request.GET['after']) if request.GET.get('after') else None
+        limit = min(int(request.GET.get('limit', CHILDREN_PAGE_SIZE)), CHILDREN_PAGE_MAX_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest()
+    if limit < 1:
+        return HttpResponseBadRequest()
+
+    # Статус оплаты последователей за текущий месяц
+    current_year = date.today().year
+    current_month = date.today().month
+
+    children, next_after = get_children_page(profile, current_year, current_month, after, limit)
+    for child in children:
+        # Последователей глубже четвертого уровня пользователь не раскрывает
+        child['expandable'] = bool(child['children_count']) and (depth is None or depth + 1 < REFERRAL_PATH_DEPTH)
+
+    return JsonResponse({
+        'children': children,
+        'next': next_after,
+    })
+
+
+def export_bonus_statements(request):
+    # Ведомость бонусов всех участников (или одного дерева) за месяц; строки отдаются по мере чтения из базы
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest()
+    try:
+        period = parse_period(request.GET['period']) if request.GET.get('period') else date.today().replace(day=1)
+        tree_id = int(request.GET['tree']) if request.GET.get('tree') else None
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    statements = iter_bonus_statements(period.year, period.month, tree_id)
+    if export_format == 'csv':
+        content_type = 'text/csv; charset=utf-8'
+    else:
+        content_type = 'application/x-ndjson; charset=utf-8'
+    response = StreamingHttpResponse(
+        iter_export_lines(statements, export_format, get_export_columns(period.year, period.month)),
+        content_type=content_type,
+    )
+    response['Content-Disposition'] = 'attachment; filename="bonus_statements_%s%s.%s"' % (
+        period.strftime('%Y-%m'),
+        '_tree%s' % tree_id if tree_id is not None else '',
+        export_format,
+    )
+    return response
+
+
+def process_referral(request, code):
+    # Переход по реферальной ссылке, как pinax.referrals.views.process_referral, но ссылка берется
+    # из кэша, а переход записывается в очередь вместо базы
+    referral = get_referral_code(code)
+    if referral is None:
+        raise Http404
+    referral_id, redirect_to = referral
+    session_key = ensure_session_key(request)
+    record_click(request, referral_id, session_key)
+    response = redirect(request.GET.get('redirect_to') or redirect_to)
+    if request.user.is_anonymous:
+        response.set_cookie('pinax-referral', '%s:%s' % (code, session_key))
+    else:
+        response.delete_cookie('pinax-referral')
+    return response
+
+
+def leaderboard(request):
+    # Первые места рейтинга за месяц и, если указан логин, место этого пользователя
+    board = request.GET.get('board', 'month_amount')
+    if board not in dict(LeaderboardEntry.BOARD_CHOICES):
+        return HttpResponseBadRequest()
+    try:
+        period = parse_period(request.GET['period']) if request.GET.get('period') else date.today().replace(day=1)
+        limit = min(int(request.GET.get('limit', LEADERBOARD_SIZE)), LEADERBOARD_MAX_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest()
+    if limit < 1:
+        return HttpResponseBadRequest()
+
+    data = {
+        'board': board,
+        'period': period.strftime('%Y-%m'),
+        'top': get_leaderboard_top(period.year, period.month, board, limit),
+    }
+    if request.GET.get('username'):
+        profile = get_object_or_404(Profile, user__username=request.GET['username'])
+        data['user'] = get_leaderboard_rank(profile, period.year, period.month, board)
+    return JsonResponse(data)
+
+
 def specify_parent(request):
     # Инициализируем словарь
     data = dict()
@@ -417,86 +427,28 @@ def specify_parent(request):
                 profile.parent = parent_profile
                 # Сохраняем данные в профиль
                 profile.save()
-                # Процент от родителя (5 %)
-                ancestor_percentage = (int(PRICE) * 5) / 100
+                # Бонусы по уровням, накопления за текущий и предыдущие месяцы
+                bonus_information = get_bonus_information(profile)
                 # Передаем переменные в шаблон
                 context = {
                     'user': request.user,
                     'request_user': request.user,
                     'parent': profile.parent.user,
-                    'amount_from_parent': ancestor_percentage,
+                    'amount_from_parent': bonus_information['amount_from_parent'],
                 }
                 # Инициализируем блок с информацией о родителе
                 data['parent_html'] = render_to_string('parent.html', context)
 
-                # Инициализируем начальные переменные
-                current_month_amount = 0
-                current_year = date.today().year
-                current_month = date.today().month
-                # Все рефералы(последователи) текущего пользователя
-                referrals = profile.get_descendants().filter(level__lte=profile.level + 4)
-                # Подсчет накопленной сумму за текущий месяц по каждому уровню
-                for referral in referrals:
-                    if Payment.objects.filter(
-                            user=referral.user,
-                            date__month=current_month,
-                            date__year=current_year,
-                            paid=True).exists():
-                        level = referral.level - profile.level
-                        if level == 1:
-                            current_month_amount = current_month_amount + (int(PRICE) * 10 / 100)
-                        elif level == 2:
-                            current_month_amount = current_month_amount + (int(PRICE) * 5 / 100)
-                        elif level == 3:
-                            current_month_amount = current_month_amount + (int(PRICE) * 2.5 / 100)
-                        elif level == 4:
-                            current_month_amount = current_month_amount + (int(PRICE) * 1 / 100)
-
-                # Если нет накоплений за предыдущие месяцы
-                if not profile.amount:
-                    last_amount = 0
-                else:
-                    last_amount = profile.amount
-                # Накопления за текущий месяц
-                current_month_amount = current_month_amount + ancestor_percentage
                 # Общие накопления
-                amount = current_month_amount + last_amount
+                amount = bonus_information['amount']
                 # Инициализируем и передаем переменные в блоки о накоплениях на текущий и прошлые месяцы
                 context = {'amount': amount, }
                 data['amount_html'] = render_to_string('amount.html', context)
-                context = {'current_month_amount': current_month_amount, }
+                context = {'current_month_amount': bonus_information['current_month_amount'], }
                 data['current_month_amount_html'] = render_to_string('current_month_amount.html', context)
 
                 # Блок с информацией о пакете
-                global accumulate, accumulate_status, accumulate_text
-                if amount <= int(CLASSIC):
-                    accumulate_status = 'Пакет "Classic"'
-                    accumulate_text = 'Необходимо накопить: ' + CLASSIC
-                    accumulate = "Осталось накопить: " + str(int(CLASSIC) - amount)
-                elif int(CLASSIC) < amount <= int(SILVER):
-                    accumulate_status = 'Пакет "Silver"'
-                    accumulate_text = 'Необходимо накопить: ' + str(SILVER) + '. Бонус + ' + str(SILVER_BONUS)
-                    accumulate = int(SILVER) - amount
-                elif int(SILVER) < amount <= int(GOLD):
-                    accumulate_status = 'Пакет "Gold"'
-                    accumulate_text = 'Необходимо накопить: ' + str(GOLD) + '. Бонус + ' + str(GOLD_BONUS)
-                    accumulate = int(SILVER) - amount
-                elif int(SILVER) < amount <= int(PLATINUM):
-                    accumulate_status = 'Пакет "Platinum"'
-                    accumulate_text = 'Необходимо накопить: ' + str(PLATINUM) + '. Бонус + ' + str(PLATINUM_BONUS)
-                    accumulate = int(PLATINUM) - amount
-                elif int(PLATINUM) < amount <= int(BRILLIANT):
-                    accumulate_status = 'Пакет "Brilliant"'
-                    accumulate_text = 'Необходимо накопить: ' + str(BRILLIANT) + '. Бонус + ' + str(BRILLIANT_BONUS)
-                    accumulate = int(BRILLIANT) - amount
-                elif amount > int(BRILLIANT):
-                    accumulate_status = 'Пакет "Brilliant"'
-                    accumulate_text = 'Вы накопили нужную сумму. Мы дарим вам ' + str(BRILLIANT_BONUS)
-                context = {
-                    'accumulate_status': accumulate_status,
-                    'accumulate_text': accumulate_text,
-                    'accumulate': accumulate
-                }
+                context = rules.get_package_information(amount)
                 data['accumulate_html'] = render_to_string('accumulate.html', context)
         else:
             data['form_is_valid'] = False
@@ -0,0 +1,80 @@
+;(function ($) {
+    // Дерево последователей: прямые последователи узла подгружаются при раскрытии, по страницам
+    var maxDepth = 4;
+
+    var childrenUrl = function (tree, id) {
+        return tree.data('url').replace(/\/\d+\/$/, '/' + id + '/');
+    };
+
+    var renderItem = function (child, depth) {
+        var item = $('<li class="dd-item"></li>').attr('data-id', child.id).attr('data-depth', depth);
+        $('<div class="dd-nodrag"></div>').text(child.username).toggleClass('not-paid', !child.paid).appendTo(item);
+        if (child.expandable && depth < maxDepth) {
+            // Кнопки в разметке nestable.js, список пустой до первого раскрытия
+            item.addClass('dd-collapsed');
+            item.prepend('<button data-action="expand" type="button">Expand</button>');
+            item.prepend($('<button data-action="collapse" type="button">Collapse</button>').hide());
+            item.append('<ol class="dd-list"></ol>');
+        }
+        return item;
+    };
+
+    var loadChildren = function (tree, id, list, depth, after) {
+        list.data('loading', true);
+        $.ajax({
+            url: childrenUrl(tree, id),
+            type: 'get',
+            dataType: 'json',
+            data: after ? {'after': after} : {},
+            success: function (data) {
+                list.children('.dd-more').remove();
+                $.each(data.children, function (index, child) {
+                    list.append(renderItem(child, depth));
+                });
+                if (data.next) {
+                    $('<li class="dd-more"><a href="#">Показать еще</a></li>')
+                        .data('after', data.next)
+                        .appendTo(list);
+                }
+                list.data('loaded', true);
+            }
+        }).always(function () {
+            list.data('loading', false);
+        });
+    };
+
+    $.fn.referralTree = function () {
+        return this.each(function () {
+            var tree = $(this);
+            if (tree.data('referral-tree')) {
+                return;
+            }
+            tree.data('referral-tree', true);
+
+            tree.on('click', 'button[data-action="expand"]', function () {
+                var item = $(this).parent('li');
+                var list = item.children('ol');
+                if (!list.data('loaded') && !list.data('loading')) {
+                    loadChildren(tree, item.data('id'), list, item.data('depth') + 1);
+                }
+            });
+
+            tree.on('click', '.dd-more a', function (e) {
+                e.preventDefault();
+                var more = $(this).parent('li');
+                var list = more.parent('ol');
+                var item = list.parent('li');
+                if (list.data('loading')) {
+                    return;
+                }
+                if (item.length) {
+                    loadChildren(tree, item.data('id'), list, item.data('depth') + 1, more.data('after'));
+                } else {
+                    loadChildren(tree, tree.data('id'), list, 1, more.data('after'));
+                }
+            });
+
+            loadChildren(tree, tree.data('id'), tree.children('ol'), 1);
+        });
+    };
+})(window.jQuery);